@@ -0,0 +1,65 @@
+"""
+Micro-benchmark of packing queued events into PutLogEvents batches, for
+100,000 events in order, nearly in order, and shuffled.
+
+"sort" is the old path, which always copies and reverse sorts the events
+and pops them off the end; "batch" is the daemon's path, which only sorts
+events which aren't in order already.
+
+Usage: python bench_batching.py  (with globus_cw_daemon installed)
+"""
+import random
+import timeit
+
+import globus_cw_daemon.cwlogs as cwlogs
+
+NR_EVENTS = 100000
+
+
+def _make_events(order):
+    start = 1500000000000
+    timestamps = [start + i // 4 for i in range(NR_EVENTS)]
+    if order == "nearly":
+        # clients' clocks and requests race a little
+        for i in range(0, NR_EVENTS - 8, 97):
+            timestamps[i], timestamps[i + 8] = timestamps[i + 8], timestamps[i]
+    elif order == "shuffled":
+        random.shuffle(timestamps)
+    return [cwlogs.Event(t, "x" * 100) for t in timestamps]
+
+
+def sort_path(events):
+    events = list(events)
+    events.sort(key=lambda x: x.timestamp, reverse=True)
+    batches = []
+    while events:
+        batch = cwlogs._Batch()
+        while events:
+            event = events[-1]
+            if not batch.add(event):
+                break
+            events.pop()
+        batches.append(batch)
+    return batches
+
+
+def batch_path(events):
+    return cwlogs._make_batches(events)
+
+
+def main():
+    print(f"{'order':>8} {'sort':>10} {'batch':>10} {'speedup':>8} {'batches':>8}")
+    for order in ("sorted", "nearly", "shuffled"):
+        events = _make_events(order)
+        results = []
+        for path in (sort_path, batch_path):
+            best = min(timeit.repeat(lambda: path(events), number=3, repeat=5))
+            results.append(best / 3 * 1000)
+        print(
+            f"{order:>8} {results[0]:>8.1f}ms {results[1]:>8.1f}ms "
+            f"{results[0] / results[1]:>7.2f}x {len(batch_path(events)):>8}"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,238 @@
+"""
+Benchmark the daemon end to end, against a local CloudWatch Logs stand-in.
+
+For each message size and client concurrency, this starts a fresh daemon
+process (the daemon's own request loop and flush thread, configured from a
+generated cwlogd.ini), has that many client processes log events through
+globus_cw_client, and waits for every event to reach the stand-in.
+
+Reported per run:
+  ingest/s:  events accepted by the daemon per second, across all clients
+  upload/s:  events received by the stand-in per second
+  p50, p99:  log_event latency, in milliseconds
+  max queue: the largest queue length reported to clients
+  busy:      events the daemon was still too busy to accept after retries
+  rss:       the daemon's peak resident memory, in MiB
+
+The daemon binds its usual socket addresses, so stop any running
+globus_cw_daemon first.
+
+Usage: python bench_daemon.py [--sizes 100,1024,65536] [--clients 1,8,32]
+                              [--mode connect|keepalive|dgram]
+                              [--latency-ms MS] [--throttle-rate FRACTION]
+                              [--set KEY=VALUE ...]
+(with globus_cw_daemon and globus_cw_client installed)
+"""
+import argparse
+import configparser
+import logging
+import multiprocessing
+import os
+import socket
+import tempfile
+import threading
+import time
+
+from fake_cloudwatch import FakeCloudWatchLogs
+
+# no run uploads more than this many bytes of messages
+MAX_RUN_BYTES = 256 * 1024 * 1024
+
+# how long to wait for all events to reach the stand-in
+UPLOAD_TIMEOUT_SECS = 120
+
+
+def _daemon_main(config_path):
+    import globus_cw_daemon.config as config
+    import globus_cw_daemon.daemon as daemon
+
+    config.CONFIG_PATH = config_path
+    logging.basicConfig(level=logging.ERROR)
+    # the stand-in doesn't check signatures, but botocore needs credentials
+    os.environ.setdefault("AWS_ACCESS_KEY_ID", "bench")
+    os.environ.setdefault("AWS_SECRET_ACCESS_KEY", "bench")
+
+    listen_sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM, 0)
+    listen_sock.bind(daemon.LISTEN_ADDR)
+    listen_sock.listen(daemon.SOCK_LISTEN_BACKLOG)
+    dgram_sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM, 0)
+    dgram_sock.setsockopt(
+        socket.SOL_SOCKET, socket.SO_RCVBUF, daemon.DGRAM_RCVBUF_BYTES
+    )
+    dgram_sock.bind(daemon.DGRAM_ADDR)
+    daemon.serve(listen_sock, dgram_sock)
+
+
+def _client_main(nr_events, message, mode, start, results):
+    from globus_cw_client.client import CWLoggerDaemonBusyError, log_event
+
+    kwargs = dict(keepalive=(mode == "keepalive"), ack=(mode != "dgram"))
+    latencies = []
+    max_queue = 0
+    nr_busy = 0
+    start.wait()
+    try:
+        for _ in range(nr_events):
+            t = time.perf_counter()
+            try:
+                response = log_event(message, **kwargs)
+            except CWLoggerDaemonBusyError:
+                # still busy after retrying, so the event is lost
+                nr_busy += 1
+                continue
+            latencies.append(time.perf_counter() - t)
+            if response is not None:
+                max_queue = max(max_queue, response["health"]["queue_length"])
+    finally:
+        results.put((latencies, max_queue, nr_busy))
+
+
+def _wait_for_daemon():
+    from globus_cw_client.client import _connect
+
+    # connecting succeeds once the daemon is listening
+    _connect(100, 0.1).close()
+
+
+def _peak_rss_mib(pid):
+    with open(f"/proc/{pid}/status") as f:
+        for line in f:
+            if line.startswith("VmHWM:"):
+                return int(line.split()[1]) / 1024
+    return 0.0
+
+
+def _percentile(values, pct):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * pct / 100))]
+
+
+def run(args, fake, size, nr_clients, config_path):
+    nr_events = min(args.events, MAX_RUN_BYTES // size) // nr_clients * nr_clients
+    message = "x" * size
+    base = fake.stats()["events"]
+
+    daemon_proc = multiprocessing.Process(target=_daemon_main, args=(config_path,))
+    daemon_proc.start()
+    try:
+        _wait_for_daemon()
+
+        start = multiprocessing.Event()
+        results = multiprocessing.Queue()
+        clients = [
+            multiprocessing.Process(
+                target=_client_main,
+                args=(nr_events // nr_clients, message, args.mode, start, results),
+            )
+            for _ in range(nr_clients)
+        ]
+        for client in clients:
+            client.start()
+
+        t_start = time.perf_counter()
+        start.set()
+        latencies = []
+        max_queue = 0
+        nr_busy = 0
+        for _ in clients:
+            client_latencies, client_max_queue, client_nr_busy = results.get()
+            latencies.extend(client_latencies)
+            max_queue = max(max_queue, client_max_queue)
+            nr_busy += client_nr_busy
+        t_ingested = time.perf_counter()
+        for client in clients:
+            client.join()
+
+        nr_accepted = len(latencies)
+        deadline = time.monotonic() + UPLOAD_TIMEOUT_SECS
+        while fake.stats()["events"] - base < nr_accepted:
+            if time.monotonic() > deadline:
+                print(f"  timed out, only {fake.stats()['events'] - base} uploaded")
+                break
+            time.sleep(0.01)
+        t_uploaded = time.perf_counter()
+        rss = _peak_rss_mib(daemon_proc.pid)
+    finally:
+        daemon_proc.terminate()
+        daemon_proc.join()
+
+    if not latencies:
+        print(f"{size:>8} {nr_clients:>7}  all {nr_busy} events rejected as busy")
+        return
+    print(
+        f"{size:>8} {nr_clients:>7} {nr_accepted / (t_ingested - t_start):>10.0f} "
+        f"{nr_accepted / (t_uploaded - t_start):>10.0f} "
+        f"{_percentile(latencies, 50) * 1000:>8.3f} "
+        f"{_percentile(latencies, 99) * 1000:>8.3f} "
+        f"{max_queue if args.mode != 'dgram' else '-':>9} {nr_busy:>6} {rss:>8.1f}"
+    )
+
+
+def _write_config(path, endpoint_url, settings):
+    config = configparser.ConfigParser()
+    config["general"] = dict(
+        group_name="bench-group",
+        stream_name="bench-stream",
+        endpoint_url=endpoint_url,
+        local_log_level="error",
+        heartbeats="false",
+        heartbeat_interval="60",
+        # events left when a run's daemon is stopped stay out of the real one
+        spill_dir=os.path.join(os.path.dirname(path), "spill"),
+    )
+    for setting in settings:
+        key, _, value = setting.partition("=")
+        config["general"][key] = value
+    with open(path, "w") as f:
+        config.write(f)
+
+
+def _int_list(value):
+    return [int(v) for v in value.split(",")]
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--sizes", type=_int_list, default=[100, 1024, 65536])
+    parser.add_argument("--clients", type=_int_list, default=[1, 8, 32])
+    parser.add_argument("--events", type=int, default=20000, help="Events per run")
+    parser.add_argument(
+        "--mode", choices=["connect", "keepalive", "dgram"], default="connect"
+    )
+    parser.add_argument("--latency-ms", type=int, default=50)
+    parser.add_argument("--throttle-rate", type=float, default=0.0)
+    parser.add_argument(
+        "--set",
+        action="append",
+        default=[],
+        metavar="KEY=VALUE",
+        help="Set a daemon config value, e.g. upload_streams=4",
+    )
+    args = parser.parse_args()
+
+    fake = FakeCloudWatchLogs(
+        latency_ms=args.latency_ms, throttle_rate=args.throttle_rate
+    )
+    threading.Thread(target=fake.serve_forever, daemon=True).start()
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        config_path = os.path.join(tmpdir, "cwlogd.ini")
+        _write_config(config_path, fake.endpoint_url, args.set)
+
+        print(
+            f"{'size':>8} {'clients':>7} {'ingest/s':>10} {'upload/s':>10} "
+            f"{'p50 ms':>8} {'p99 ms':>8} {'max queue':>9} {'busy':>6} {'rss MiB':>8}"
+        )
+        for size in args.sizes:
+            for nr_clients in args.clients:
+                run(args, fake, size, nr_clients, config_path)
+
+    stats = fake.stats()
+    print(
+        f"PutLogEvents calls: {stats['calls']}, throttled: {stats['throttled']}, "
+        f"body MiB: {stats['bytes'] / 1024 / 1024:.1f}"
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,65 @@
+"""
+Micro-benchmark of the daemon's per-event CPU cost, from request frame to
+PutLogEvents body, for 1KiB, 64KiB and 256KiB messages.
+
+"decode" is the path which decodes each message and has it encoded again for
+the upload; "passthrough" is the daemon's path, which embeds the message JSON
+from the request in the upload as-is.
+
+Usage: python bench_ingest.py  (with globus_cw_daemon installed)
+"""
+import json
+import timeit
+
+import globus_cw_daemon.cwlogs as cwlogs
+import globus_cw_daemon.daemon as daemon
+
+# the largest message which fits in an event
+MAX_MESSAGE_BYTES = cwlogs.MAX_EVENT_BYTES - 26
+
+SIZES = [("1KiB", 1024), ("64KiB", 64 * 1024), ("256KiB", MAX_MESSAGE_BYTES)]
+
+# a typical audit record is JSON, so its quotes are escaped when sent
+RECORD = json.dumps({"type": "audit", "user": "someone", "detail": "x" * 64})
+
+
+def _make_frame(size):
+    message = (RECORD * (size // len(RECORD) + 1))[:size]
+    req = dict(message=message, timestamp=1500000000000)
+    return json.dumps(req, indent=None).encode("utf-8")
+
+
+def decode_path(frame):
+    d = json.loads(frame.decode("utf-8"))
+    event = cwlogs.Event(timestamp=d["timestamp"], message=d["message"])
+    records = [dict(timestamp=event.timestamp, message=event.unicode_message)]
+    return json.dumps(dict(logEvents=records)).encode("utf-8")
+
+
+def passthrough_path(frame):
+    d, json_message = daemon._parse_request(frame)
+    event = cwlogs.Event(
+        timestamp=d["timestamp"], message=d["message"], json_message=json_message
+    )
+    batch = cwlogs._Batch()
+    batch.add(event)
+    return batch.get_records_json()
+
+
+def main():
+    print(f"{'size':>8} {'decode':>12} {'passthrough':>12} {'speedup':>8}")
+    for label, size in SIZES:
+        frame = _make_frame(size)
+        number = max(20, 20000 * 1024 // size)
+        results = []
+        for path in (decode_path, passthrough_path):
+            best = min(timeit.repeat(lambda: path(frame), number=number, repeat=5))
+            results.append(best / number * 1e6)
+        print(
+            f"{label:>8} {results[0]:>10.1f}us {results[1]:>10.1f}us "
+            f"{results[0] / results[1]:>7.2f}x"
+        )
+
+
+if __name__ == "__main__":
+    main()
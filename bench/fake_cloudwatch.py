@@ -0,0 +1,134 @@
+"""
+A local stand-in for the CloudWatch Logs API, for benchmarks.
+
+It accepts CreateLogStream and PutLogEvents, counts the events and request
+body bytes it receives, and can add latency and throttle a fraction of
+PutLogEvents calls. gzip'd bodies are accepted, unless told to reject them.
+Any other API call gets an error.
+
+Usage: python fake_cloudwatch.py [--port PORT] [--latency-ms MS]
+                                 [--throttle-rate FRACTION] [--reject-gzip]
+"""
+import argparse
+import gzip
+import http.server
+import json
+import random
+import sys
+import threading
+import time
+
+
+class FakeCloudWatchLogs(http.server.ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, port=0, latency_ms=0, throttle_rate=0.0, reject_gzip=False):
+        super().__init__(("127.0.0.1", port), _Handler)
+        self.latency_ms = latency_ms
+        self.throttle_rate = throttle_rate
+        self.reject_gzip = reject_gzip
+        self.lock = threading.Lock()
+        self.nr_events = 0
+        self.nr_bytes = 0
+        # events received, by (group name, stream name)
+        self.nr_stream_events = {}
+        self.nr_calls = 0
+        self.nr_throttled = 0
+
+    @property
+    def endpoint_url(self):
+        return "http://{}:{}".format(*self.server_address)
+
+    def stats(self):
+        with self.lock:
+            return dict(
+                events=self.nr_events,
+                bytes=self.nr_bytes,
+                streams=dict(self.nr_stream_events),
+                calls=self.nr_calls,
+                throttled=self.nr_throttled,
+            )
+
+    def handle_error(self, request, client_address):
+        # clients going away, e.g. a daemon being stopped, are expected
+        if not isinstance(sys.exc_info()[1], ConnectionError):
+            super().handle_error(request, client_address)
+
+
+class _Handler(http.server.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers["Content-Length"]))
+        operation = self.headers.get("X-Amz-Target", "").split(".")[-1]
+        if operation == "CreateLogStream":
+            self._respond(200, {})
+        elif operation == "PutLogEvents":
+            self._put_log_events(body)
+        else:
+            self._respond(400, _error("InvalidOperationException", operation))
+
+    def _put_log_events(self, body):
+        server = self.server
+        if server.latency_ms:
+            time.sleep(server.latency_ms / 1000)
+        if random.random() < server.throttle_rate:
+            with server.lock:
+                server.nr_throttled += 1
+            self._respond(400, _error("ThrottlingException", "Rate exceeded"))
+            return
+
+        nr_bytes = len(body)
+        if self.headers.get("Content-Encoding") == "gzip":
+            if server.reject_gzip:
+                # as a service which doesn't decode the body would
+                self._respond(400, _error("SerializationException", "bad JSON"))
+                return
+            body = gzip.decompress(body)
+
+        d = json.loads(body)
+        nr_events = len(d["logEvents"])
+        stream = (d["logGroupName"], d["logStreamName"])
+        with server.lock:
+            server.nr_stream_events[stream] = (
+                server.nr_stream_events.get(stream, 0) + nr_events
+            )
+            server.nr_events += nr_events
+            server.nr_bytes += nr_bytes
+            server.nr_calls += 1
+            token = str(server.nr_calls)
+        self._respond(200, dict(nextSequenceToken=token))
+
+    def _respond(self, status, data):
+        out = json.dumps(data).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/x-amz-json-1.1")
+        self.send_header("Content-Length", str(len(out)))
+        self.end_headers()
+        self.wfile.write(out)
+
+    def log_message(self, *args):
+        pass
+
+
+def _error(code, message):
+    return {"__type": code, "message": message}
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--port", type=int, default=4566)
+    parser.add_argument("--latency-ms", type=int, default=0)
+    parser.add_argument("--throttle-rate", type=float, default=0.0)
+    parser.add_argument("--reject-gzip", action="store_true")
+    args = parser.parse_args()
+
+    server = FakeCloudWatchLogs(
+        args.port, args.latency_ms, args.throttle_rate, args.reject_gzip
+    )
+    print(f"listening on {server.endpoint_url}")
+    server.serve_forever()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,270 @@
+"""
+asyncio client API for cwlogs daemon
+
+These speak the same protocol as globus_cw_client.client, over persistent
+connections, without blocking the event loop: connecting, sending, waiting
+for the daemon's reply and waiting between retries all yield to other tasks.
+"""
+import asyncio
+import collections
+import os
+import typing
+
+from globus_cw_client.client import (
+    _ADDR,
+    CWLoggerConnectionError,
+    CWLoggerDaemonBusyError,
+    _busy_wait,
+    _BusyRetry,
+    _check_retry_args,
+    _encode_request,
+    _make_batch_request,
+    _make_destination,
+    _make_event_request,
+    _parse_response,
+)
+
+# Longest response line read from the daemon, e.g. the results of a large batch
+MAX_RESPONSE_BYTES = 16 * 1024 * 1024
+
+try:
+    _current_task = asyncio.current_task
+except AttributeError:
+    # python3.6; Task.current_task is gone from python3.9
+    _current_task = asyncio.Task.current_task  # type: ignore[attr-defined]
+
+# per-event loop (pid, logger), used by log_event and log_events
+_loggers: typing.Dict[asyncio.AbstractEventLoop, typing.Tuple[int, typing.Any]] = {}
+
+
+async def log_event(message, retries=10, wait=0.1, group_name=None, stream_name=None):
+    """
+    Log the @message string to cloudwatch logs, using the current time.
+    Messages are sent over a persistent connection, one per event loop, which
+    concurrent tasks share; their requests are pipelined.
+    message, retries, wait, group_name, stream_name: as for
+        globus_cw_client.client.log_event
+    Raises and Returns as for globus_cw_client.client.log_event
+    """
+    _check_retry_args(retries, wait)
+    req = _make_event_request(message, _make_destination(group_name, stream_name))
+    return await _get_loop_logger()._request(req, retries, wait)
+
+
+async def log_events(messages, retries=10, wait=0.1, group_name=None, stream_name=None):
+    """
+    Log each string in the @messages iterable to cloudwatch logs, in a single
+    request to the daemon, over the event loop's persistent connection.
+    messages, retries, wait, group_name, stream_name: as for
+        globus_cw_client.client.log_events
+    Raises and Returns as for globus_cw_client.client.log_events
+    """
+    _check_retry_args(retries, wait)
+    req = _make_batch_request(messages, _make_destination(group_name, stream_name))
+    return await _get_loop_logger()._request(req, retries, wait)
+
+
+def _get_loop_logger():
+    """
+    Get the logger for the running event loop, creating it if needed.
+    A logger inherited across fork() is discarded, never shared.
+    """
+    loop = asyncio.get_event_loop()
+    pid, logger = _loggers.get(loop, (None, None))
+    if logger is None or pid != os.getpid():
+        # the loggers of closed loops had their connections closed along with
+        # their tasks, e.g. at the end of asyncio.run()
+        for closed in [other for other in _loggers if other.is_closed()]:
+            del _loggers[closed]
+        logger = AsyncCWLogger()
+        _loggers[loop] = (os.getpid(), logger)
+    return logger
+
+
+async def _connect(retries, wait):
+    """
+    Try to connect to the daemon @retries + 1 times,
+    waiting @wait seconds between tries
+    Raise: Exception if max attempts exceeded
+    """
+    for _ in range(retries + 1):
+        try:
+            return await asyncio.open_unix_connection(_ADDR, limit=MAX_RESPONSE_BYTES)
+        except OSError as err:
+            error = err
+        await asyncio.sleep(wait)  # seconds
+
+    raise CWLoggerConnectionError("couldn't connect to cw", error)
+
+
+class AsyncCWLogger:
+    """
+    A persistent connection to the daemon, for use from asyncio code.
+
+    Any number of tasks of one event loop may log through the same logger at
+    once: their requests are pipelined on the connection, and each task waits
+    only for its own reply. A task cancelled while waiting doesn't disturb the
+    replies of the others.
+
+    The connection is made on first use, and remade if the daemon closes it.
+    """
+
+    def __init__(self, retries=10, wait=0.1):
+        _check_retry_args(retries, wait)
+        self._retries = retries
+        self._retry_wait = wait
+        self._conn = None
+        # created on first use, in the event loop which uses it
+        self._lock = None
+
+    async def log_event(self, message, group_name=None, stream_name=None):
+        """
+        Log the @message string to cloudwatch logs, using the current time,
+        and wait for the daemon to queue it.
+        Raises and Returns as for globus_cw_client.client.log_event
+        """
+        req = _make_event_request(message, _make_destination(group_name, stream_name))
+        return await self._request(req, self._retries, self._retry_wait)
+
+    async def log_events(self, messages, group_name=None, stream_name=None):
+        """
+        Log each string in the @messages iterable to cloudwatch logs, in a
+        single request, and wait for the daemon to handle it.
+        Raises and Returns as for globus_cw_client.client.log_events
+        """
+        req = _make_batch_request(messages, _make_destination(group_name, stream_name))
+        return await self._request(req, self._retries, self._retry_wait)
+
+    async def close(self):
+        """
+        Close the connection. Requests still awaiting replies fail with
+        CWLoggerConnectionError.
+        """
+        if self._conn is not None:
+            self._conn.close("connection closed")
+            await self._conn.wait_closed()
+        self._conn = None
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *args):
+        await self.close()
+
+    async def _request(self, req, retries, wait):
+        busy = _BusyRetry(req)
+        for attempt in range(retries + 1):
+            if attempt:
+                await asyncio.sleep(_busy_wait(attempt, wait))
+            try:
+                d = await self._request_once(busy.req, retries, wait)
+            except CWLoggerDaemonBusyError:
+                if attempt == retries:
+                    raise
+                continue
+            if busy.done(d):
+                break
+        return busy.response
+
+    async def _request_once(self, req, retries, wait):
+        buf = _encode_request(req)
+
+        # a connection which was open before this request may have been closed
+        # by the daemon in the meantime, in which case resend on a fresh one
+        reused = self._conn is not None and not self._conn.closed
+        try:
+            reply = await self._send(buf, retries, wait)
+            line = await reply
+        except CWLoggerConnectionError:
+            if not reused:
+                raise
+            reply = await self._send(buf, retries, wait)
+            line = await reply
+        return _parse_response(line)
+
+    async def _send(self, buf, retries, wait):
+        """
+        Send @buf, connecting first if needed.
+        Returns: a future for the daemon's reply line
+        """
+        if self._lock is None:
+            self._lock = asyncio.Lock()
+        # writes and their replies must stay in the same order, and only one
+        # task may wait to drain the connection at a time
+        async with self._lock:
+            if self._conn is None or self._conn.closed:
+                reader, writer = await _connect(retries, wait)
+                self._conn = _Connection(reader, writer)
+            return await self._conn.send(buf)
+
+
+class _Connection:
+    """
+    One connection to the daemon, and the replies it owes, in request order.
+    A background task reads the replies and hands each to its request.
+    """
+
+    def __init__(self, reader, writer):
+        self._reader = reader
+        self._writer = writer
+        self._replies = collections.deque()
+        self.closed = False
+        self._read_task = asyncio.ensure_future(self._read_replies())
+
+    async def send(self, buf):
+        if self.closed:
+            raise CWLoggerConnectionError("lost connection to cw", "closed")
+        reply = asyncio.get_event_loop().create_future()
+        self._replies.append(reply)
+        self._writer.write(buf)
+        try:
+            await self._writer.drain()
+        except OSError as err:
+            self.close(err)
+        except BaseException:
+            # cancelled, so nothing will wait for the reply
+            reply.cancel()
+            raise
+        return reply
+
+    async def _read_replies(self):
+        try:
+            while True:
+                line = await self._reader.readuntil(b"\n")
+                if not self._replies:
+                    raise CWLoggerConnectionError("unexpected reply", line)
+                reply = self._replies.popleft()
+                # the request may have been cancelled
+                if not reply.done():
+                    reply.set_result(line[:-1])
+        except asyncio.IncompleteReadError:
+            self.close("no data")
+        except asyncio.CancelledError:
+            # by close(), or as the event loop is shut down
+            self.close("cancelled")
+            raise
+        except Exception as err:
+            self.close(err)
+
+    def close(self, reason):
+        """
+        Close the connection, failing requests still awaiting replies.
+        """
+        if self.closed:
+            return
+        self.closed = True
+        self._writer.close()
+        if self._read_task is not _current_task():
+            self._read_task.cancel()
+        while self._replies:
+            reply = self._replies.popleft()
+            if not reply.done():
+                reply.set_exception(
+                    CWLoggerConnectionError("lost connection to cw", reason)
+                )
+
+    async def wait_closed(self):
+        try:
+            await self._read_task
+        except asyncio.CancelledError:
+            pass
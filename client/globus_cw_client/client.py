@@ -1,9 +1,28 @@
 """
 Python client API for cwlogs daemon
 """
+import errno
 import json
+import os
+import random
+import select
 import socket
+import threading
 import time
+import typing
+
+# Longest wait between retries of a request the daemon was too busy for
+MAX_BUSY_WAIT = 2.0
+
+_ADDR = "\0org.globus.cwlogs"
+_DGRAM_ADDR = "\0org.globus.cwlogs.dgram"
+
+# per-thread persistent connections, used by log_event(..., keepalive=True)
+_local = threading.local()
+
+# spools messages which can't be delivered, once enabled by
+# globus_cw_client.fallback.enable()
+_fallback = None
 
 
 def _checktype(value, types, message):
@@ -11,22 +30,94 @@ def _checktype(value, types, message):
         raise TypeError(message)
 
 
-def log_event(message, retries=10, wait=0.1):
+def log_event(
+    message,
+    retries=10,
+    wait=0.1,
+    keepalive=False,
+    ack=True,
+    group_name=None,
+    stream_name=None,
+):
     """
     Log the @message string to cloudwatch logs, using the current time.
     message: bytes (valid utf8 required) or unicode.
-    retries: number of retries to make on failed socket connection
-    wait: number of seconds to wait between retries
+    retries: number of retries to make on failed socket connection, or when
+             the daemon is too busy to queue the message
+    wait: number of seconds to wait between retries; busy retries back off
+          exponentially from this, with jitter
+    keepalive: reuse a persistent connection to the daemon, one per thread,
+               instead of connecting for every message
+    ack: if False, send the message in a single datagram and don't wait for
+         the daemon to reply. Errors are then only counted by the daemon, as
+         dropped events.
+    group_name, stream_name: the log group and stream to send the message
+         to, each defaulting to the daemon's own. The daemon uploads to each
+         destination separately, from its own queue.
     Raises: exception if the message is too long or invalid utf8
-    Raises: exception if the daemon is down or too backlogged
+    Raises: exception if the daemon is down or still too backlogged after
+            retrying (CWLoggerDaemonBusyError)
     Returns when the message was queued to the daemon's memory queue.
     (Does not mean the message is safe in cloudwatch)
+    With ack=False, returns None once the message was sent to the daemon.
+    With the fallback spool enabled (see globus_cw_client.fallback), a
+    message which can't be delivered, because the daemon is down or busy, is
+    spooled instead, and {"status": "spooled"} returned.
     """
-    # python3 json library can't handle bytes, so preemptively decode utf-8
-    if isinstance(message, bytes):
-        message = message.decode("utf-8")
-    _checktype(message, str, "message type must be bytes or unicode")
+    _check_retry_args(retries, wait)
+    req = _make_event_request(message, _make_destination(group_name, stream_name))
+    return _deliver(req, retries, wait, keepalive, ack)
+
+
+def log_events(
+    messages,
+    retries=10,
+    wait=0.1,
+    keepalive=False,
+    ack=True,
+    group_name=None,
+    stream_name=None,
+):
+    """
+    Log each string in the @messages iterable to cloudwatch logs, in a single
+    request to the daemon. Each message is stamped with the current time as
+    it is read from @messages.
+    messages: iterable of bytes (valid utf8 required) or unicode.
+    retries, wait, keepalive, ack, group_name, stream_name: as for log_event
+    Raises: exception if the daemon is down
+    Returns when the batch was handled by the daemon. The response's "results"
+    list holds one {"status": "ok"} or {"status": "error", "message": ...}
+    per message, in order; messages too long, invalid utf8, or rejected by a
+    backlogged daemon ({"status": "busy", ...}, after retrying) are reported
+    there.
+    With ack=False, returns None once the batch was sent to the daemon.
+    With the fallback spool enabled, messages which can't be delivered are
+    spooled, and reported as {"status": "spooled"}.
+    """
+    _check_retry_args(retries, wait)
+    req = _make_batch_request(messages, _make_destination(group_name, stream_name))
+    return _deliver(req, retries, wait, keepalive, ack)
+
+
+def _deliver(req, retries, wait, keepalive, ack):
+    fallback = _fallback
+    if fallback is not None:
+        return fallback.log(
+            req, ack, lambda: _send_request(req, retries, wait, keepalive, ack)
+        )
+    return _send_request(req, retries, wait, keepalive, ack)
 
+
+def _send_request(req, retries, wait, keepalive, ack):
+    if not ack:
+        return _send_datagram(req, retries, wait)
+    if keepalive:
+        conn = _get_thread_connection()
+        return conn._request(req, retries, wait)
+    return _request(req, retries, wait)
+
+
+def _check_retry_args(retries, wait):
     _checktype(retries, int, "retries must be an int")
     if retries < 0:
         raise ValueError("retries must be non-negative")
@@ -35,10 +126,60 @@ def log_event(message, retries=10, wait=0.1):
     if wait < 0:
         raise ValueError("wait must be non-negative")
 
+
+def _make_destination(group_name, stream_name):
+    destination = dict()
+    if group_name is not None:
+        _checktype(group_name, str, "group_name must be a str")
+        destination["group_name"] = group_name
+    if stream_name is not None:
+        _checktype(stream_name, str, "stream_name must be a str")
+        destination["stream_name"] = stream_name
+    return destination or None
+
+
+def _make_event_request(message, destination=None, timestamp=None):
+    # python3 json library can't handle bytes, so preemptively decode utf-8
+    if isinstance(message, bytes):
+        message = message.decode("utf-8")
+    _checktype(message, str, "message type must be bytes or unicode")
+
     req = dict()
     req["message"] = message
-    req["timestamp"] = int(time.time() * 1000)
-    return _request(req, retries, wait)
+    req["timestamp"] = int(time.time() * 1000) if timestamp is None else timestamp
+    if destination is not None:
+        req["destination"] = destination
+    return req
+
+
+def _make_batch_request(messages, destination=None):
+    req = dict()
+    # invalid utf-8 is sent as lone surrogates, which the daemon rejects with
+    # an error result for that message alone
+    req["messages"] = [
+        _make_event_request(
+            message.decode("utf-8", "surrogateescape")
+            if isinstance(message, bytes)
+            else message
+        )
+        for message in messages
+    ]
+    if destination is not None:
+        req["destination"] = destination
+    return req
+
+
+def _get_thread_connection():
+    """
+    Get the persistent connection for the current thread, creating it if needed.
+    A connection inherited across fork() is discarded, never shared.
+    """
+    conn = getattr(_local, "conn", None)
+    if conn is None or _local.pid != os.getpid():
+        conn = CWLoggerConnection()
+        _local.conn = conn
+        _local.pid = os.getpid()
+    return conn
 
 
 def _connect(retries, wait):
@@ -47,11 +188,10 @@ def _connect(retries, wait):
     waiting @wait seconds between tries
     Raise: Exception if max attempts exceeded
     """
-    addr = "\0org.globus.cwlogs"
     for _ in range(retries + 1):
         sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM, 0)
         try:
-            sock.connect(addr)
+            sock.connect(_ADDR)
         except Exception as err:
             sock.close()
             error = err
@@ -62,35 +202,394 @@ def _connect(retries, wait):
     raise CWLoggerConnectionError("couldn't connect to cw", error)
 
 
-def _request(req, retries, wait):
+def _send_datagram(req, retries, wait):
+    """
+    Send @req to the daemon's datagram socket, without waiting for a reply.
+    Try @retries + 1 times, waiting @wait seconds between tries, while the
+    daemon can't be reached or its socket's queue stays full; a full queue is
+    waited on until it has room, for up to @wait seconds.
+    Requests too large for a datagram are sent over a connection instead.
+    Raise: CWLoggerDaemonError if such a request is rejected
+    Raise: CWLoggerConnectionError if max attempts exceeded
+    """
+    buf = _encode_request(req)
+    attempt = 0
+    while True:
+        try:
+            sock = _get_dgram_socket()
+            sock.send(buf, socket.MSG_DONTWAIT)
+        except OSError as err:
+            if err.errno == errno.EMSGSIZE:
+                # too large for a datagram, so fall back to an acknowledged
+                # request, and raise its errors as log_event would
+                d = _request(req, retries, wait)
+                for result in d.get("results", ()):
+                    if result["status"] != "ok":
+                        raise CWLoggerDaemonError("forwarded error", result["message"])
+                return None
+            error = err
+            if err.errno == errno.EAGAIN:
+                # the daemon's queue is full; only a wait which runs out
+                # counts as a try, as other clients may take the room first
+                if _wait_writable(sock, wait):
+                    continue
+            else:
+                # e.g. a daemon which restarted, leaving the socket
+                # connected to its old one
+                _close_dgram_socket()
+                time.sleep(wait)  # seconds
+        else:
+            return None
+        attempt += 1
+        if attempt > retries:
+            raise CWLoggerConnectionError("couldn't send to cw", error)
+
+
+def _get_dgram_socket():
+    """
+    Returns: this thread's datagram socket, connected to the daemon's, so that
+             it polls writable once the daemon's has room
+    """
+    sock = getattr(_local, "dgram_sock", None)
+    if sock is None:
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM, 0)
+        try:
+            sock.connect(_DGRAM_ADDR)
+        except OSError:
+            sock.close()
+            raise
+        _local.dgram_sock = sock
+    return sock
+
+
+def _close_dgram_socket():
+    sock = getattr(_local, "dgram_sock", None)
+    if sock is not None:
+        sock.close()
+        _local.dgram_sock = None
+
+
+def _wait_writable(sock, timeout):
+    """
+    Returns: True if @sock became writable within @timeout seconds
+    """
+    poller = select.poll()
+    poller.register(sock, select.POLLOUT)
+    return bool(poller.poll(timeout * 1000))
+
+
+def _encode_request(req):
     buf = json.dumps(req, indent=None) + "\n"
     # dumps returns unicode with python3, but sock requires bytes
-    if isinstance(buf, str):
-        buf = buf.encode("utf-8")
+    return buf.encode("utf-8")
 
-    sock = _connect(retries, wait)
-    sock.sendall(buf)
 
-    resp = ""
-    while True:
-        chunk = sock.recv(4000)
-        if not chunk:
-            raise Exception("no data")
-        resp += chunk.decode("utf-8")
-        if resp.endswith("\n"):
+def _request(req, retries, wait):
+    return _retry_busy(
+        lambda req: _request_once(req, retries, wait), req, retries, wait
+    )
+
+
+def _retry_busy(request, req, retries, wait):
+    """
+    Send @req with @request(req), retrying up to @retries times while the
+    daemon is too busy, with capped exponential backoff and full jitter.
+    Only the busy messages of a batch request are retried.
+    Raise: CWLoggerDaemonBusyError if the daemon is still busy
+    """
+    busy = _BusyRetry(req)
+    for attempt in range(retries + 1):
+        if attempt:
+            time.sleep(_busy_wait(attempt, wait))
+        try:
+            d = request(busy.req)
+        except CWLoggerDaemonBusyError:
+            if attempt == retries:
+                raise
+            continue
+        if busy.done(d):
             break
+    return busy.response
+
+
+def _busy_wait(attempt, wait):
+    return random.uniform(0, min(MAX_BUSY_WAIT, wait * 2**attempt))
+
+
+class _BusyRetry:
+    """
+    The state of a request being retried while the daemon is busy: the next
+    request to send, and the response so far.
+    """
 
-    d = json.loads(resp[:-1])
+    def __init__(self, req):
+        self.req = req
+        self.response = None
+        # the positions in the response of the messages of self.req
+        self._indices: typing.List[int] = []
+
+    def done(self, d):
+        """
+        Record the response @d to self.req, merging the results of resent
+        batch messages into the first response.
+        Returns: True if no messages are left to resend
+        """
+        if "messages" not in self.req:
+            self.response = d
+            return True
+        if self.response is None:
+            self.response = d
+            self._indices = list(range(len(d["results"])))
+        else:
+            for i, result in zip(self._indices, d["results"]):
+                self.response["results"][i] = result
+            self.response["health"] = d["health"]
+
+        # resend just the busy messages, keeping their original timestamps
+        busy = [
+            (i, m)
+            for i, m in zip(self._indices, self.req["messages"])
+            if self.response["results"][i]["status"] == "busy"
+        ]
+        if not busy:
+            return True
+        self._indices = [i for i, _ in busy]
+        self.req = dict(self.req, messages=[m for _, m in busy])
+        return False
+
+
+def _request_once(req, retries, wait):
+    buf = _encode_request(req)
+
+    sock = _connect(retries, wait)
+    try:
+        sock.sendall(buf)
+
+        resp = b""
+        while True:
+            chunk = sock.recv(4000)
+            if not chunk:
+                raise Exception("no data")
+            resp += chunk
+            if resp.endswith(b"\n"):
+                break
+    finally:
+        sock.close()
+
+    return _parse_response(resp[:-1])
+
+
+def _parse_response(line):
+    d = json.loads(line.decode("utf-8"))
     if isinstance(d, dict):
         status = d["status"]
         if status == "ok":
             return d
+        elif status == "busy":
+            raise CWLoggerDaemonBusyError("daemon busy", d["message"])
         else:
             raise CWLoggerDaemonError("forwarded error", d["message"])
     else:
         raise CWLoggerDaemonError("unknown response type", d)
 
 
+class CWLoggerConnection:
+    """
+    A persistent connection to the daemon, which carries many
+    newline-delimited requests.
+
+    log_event() waits for the daemon's reply to each message.
+    send_event() pipelines messages without waiting, and wait() then collects
+    the replies for every pipelined message, in order.
+
+    A connection is not thread-safe; use one per thread.
+    """
+
+    def __init__(self, retries=10, wait=0.1):
+        _check_retry_args(retries, wait)
+        self._retries = retries
+        self._retry_wait = wait
+        self._sock = None
+        self._rbuf = b""
+        # the requests sent whose replies have not been read yet, in order:
+        # pipelined ones, or None for one being waited on
+        self._sent: typing.List[typing.Optional[dict]] = []
+        # (request, reply line) for pipelined requests whose replies were
+        # read while waiting on a later request, for wait() to report; the
+        # reply is a CWLoggerConnectionError if the connection was lost first
+        self._replies: typing.List[typing.Tuple[dict, typing.Any]] = []
+
+    def log_event(self, message, group_name=None, stream_name=None):
+        """
+        Log the @message string to cloudwatch logs, using the current time,
+        and wait for the daemon to queue it.
+        Replies to previously pipelined messages are kept for wait().
+        Raises and Returns as for globus_cw_client.client.log_event
+        """
+        req = _make_event_request(message, _make_destination(group_name, stream_name))
+        return self._request(req, self._retries, self._retry_wait)
+
+    def log_events(self, messages, group_name=None, stream_name=None):
+        """
+        Log each string in the @messages iterable to cloudwatch logs, in a
+        single request, and wait for the daemon to handle it.
+        Replies to previously pipelined messages are kept for wait().
+        Raises and Returns as for globus_cw_client.client.log_events
+        """
+        req = _make_batch_request(messages, _make_destination(group_name, stream_name))
+        return self._request(req, self._retries, self._retry_wait)
+
+    def send_event(self, message, group_name=None, stream_name=None):
+        """
+        Send the @message string to the daemon without waiting for a reply.
+        Call wait() to collect the replies.
+        Raises: CWLoggerConnectionError if the daemon can't be reached
+        """
+        req = _make_event_request(message, _make_destination(group_name, stream_name))
+        self._send(_encode_request(req), req)
+
+    def wait(self):
+        """
+        Read the replies to all messages sent with send_event(), resending
+        those the daemon was too busy for as log_event would.
+        Returns: the list of responses, in the order the messages were sent
+        Raises: CWLoggerError for the first message which failed, after all
+                replies have been read; its index attribute is the message's
+                position in the list. CWLoggerConnectionError if the
+                connection was lost before its reply was read.
+        """
+        try:
+            while self._sent:
+                self._replies.append(self._recv_line())
+        except CWLoggerConnectionError:
+            # the messages whose replies were lost are in self._replies
+            pass
+        replies, self._replies = self._replies, []
+        responses = []
+        error = None
+        for i, (req, reply) in enumerate(replies):
+            try:
+                if isinstance(reply, CWLoggerConnectionError):
+                    raise CWLoggerConnectionError(*reply.args)
+                try:
+                    d = _parse_response(reply)
+                except CWLoggerDaemonBusyError:
+                    if not self._retries:
+                        raise
+                    d = self._retry_busy_reply(req)
+                responses.append(d)
+            except CWLoggerError as err:
+                err.index = i
+                responses.append(None)
+                if error is None:
+                    error = err
+        if error is not None:
+            raise error
+        return responses
+
+    def close(self):
+        """
+        Close the connection. Replies to pipelined messages are discarded.
+        """
+        if self._sock is not None:
+            self._sock.close()
+        self._sock = None
+        self._rbuf = b""
+        self._sent = []
+        self._replies = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def _request(self, req, retries, wait):
+        return _retry_busy(
+            lambda req: self._request_once(req, retries, wait), req, retries, wait
+        )
+
+    def _retry_busy_reply(self, req):
+        """
+        Resend the pipelined @req, which the daemon was too busy for, with the
+        retries log_event would have left
+        """
+        time.sleep(_busy_wait(1, self._retry_wait))
+        return self._request(req, self._retries - 1, self._retry_wait)
+
+    def _request_once(self, req, retries, wait):
+        buf = _encode_request(req)
+
+        # a connection which was open before this request may have been closed
+        # by the daemon in the meantime, in which case resend on a fresh one
+        reused = self._sock is not None
+        try:
+            self._send(buf, None, retries, wait)
+            line = self._recv_reply()
+        except CWLoggerConnectionError:
+            if not reused:
+                raise
+            self._send(buf, None, retries, wait)
+            line = self._recv_reply()
+        return _parse_response(line)
+
+    def _recv_reply(self):
+        """
+        Read replies up to that of the request being waited on, keeping
+        those to pipelined requests sent before it for wait()
+        Returns: its reply line
+        """
+        while True:
+            req, line = self._recv_line()
+            if req is None:
+                return line
+            self._replies.append((req, line))
+
+    def _send(self, buf, req, retries=None, wait=None):
+        if self._sock is None:
+            self._sock = _connect(
+                self._retries if retries is None else retries,
+                self._retry_wait if wait is None else wait,
+            )
+        try:
+            self._sock.sendall(buf)
+        except OSError as err:
+            self._lost(err)
+            raise CWLoggerConnectionError("lost connection to cw", err)
+        self._sent.append(req)
+
+    def _recv_line(self):
+        """
+        Returns: the next reply line, and the pipelined request it's for, or
+                 None for the request being waited on
+        """
+        while b"\n" not in self._rbuf:
+            try:
+                chunk = self._sock.recv(4000)
+            except OSError as err:
+                self._lost(err)
+                raise CWLoggerConnectionError("lost connection to cw", err)
+            if not chunk:
+                self._lost("no data")
+                raise CWLoggerConnectionError("lost connection to cw", "no data")
+            self._rbuf += chunk
+        line, self._rbuf = self._rbuf.split(b"\n", 1)
+        return self._sent.pop(0), line
+
+    def _lost(self, err):
+        """
+        Close the lost connection, keeping a CWLoggerConnectionError for wait()
+        to report for each pipelined request whose reply is lost with it
+        """
+        replies = self._replies + [
+            (req, CWLoggerConnectionError("lost connection to cw", err))
+            for req in self._sent
+            if req is not None
+        ]
+        self.close()
+        self._replies = replies
+
+
 """
 Ignore (swallow) these exceptions at your own risk.
 CWLoggerDaemonError can be caused by many things, including but not limited to:
@@ -99,7 +598,7 @@ invalid length/encoding.
 
 Ignore only if you have some other mechanism
 (e.g. a lambda / cloudwatch / heartbeat monitor) to ensure logs are properly configured
-and working, and/or write logs to disk manually.
+and working, and/or keep logs on disk, e.g. with the daemon's file sink.
 
 Note that even in the absence of exceptions, messages may still be lost - the daemon
 has a very large memory queue and works asynchronously.
@@ -124,3 +623,10 @@ class CWLoggerDaemonError(CWLoggerError):
     Raised for errors returned to the client
     by the daemon.
     """
+
+
+class CWLoggerDaemonBusyError(CWLoggerDaemonError):
+    """
+    Raised when the daemon's queue is too full to accept more events.
+    The request may succeed if retried later.
+    """
@@ -0,0 +1,313 @@
+"""
+An opt-in fallback for when the daemon can't be reached: once enable() is
+called, messages which log_event and log_events can't deliver, for the daemon
+being down or too busy, are appended to a spool file of this process's, and
+the call returns at once. A background thread forwards the spooled messages,
+with their original timestamps, once the daemon accepts them again.
+
+While messages are spooled, new ones are spooled behind them without trying
+the daemon, so that they keep their order and callers never wait on it; only
+the first failure waits out the caller's retries.
+
+Spool files are named by pid, and locked by the process writing them. One
+left behind by a process which exited before it was forwarded is forwarded,
+then deleted, by the next process to enable the fallback on the same
+directory. Messages are forwarded at least once: some may be sent twice if
+a process exits while forwarding them.
+"""
+import errno
+import fcntl
+import json
+import os
+import threading
+import time
+
+import globus_cw_client.client as client
+
+# Unless overridden: spool files are kept under this directory, in a
+# directory of each user's, and messages which would take a process's spool
+# file over this size are not spooled
+SPOOL_DIR = "/var/tmp"
+SPOOL_MAX_BYTES = 64 * 1024 * 1024
+
+SPOOL_SUFFIX = ".spool"
+
+# The most messages forwarded in one request
+FORWARD_BATCH = 500
+# Seconds between attempts to forward spooled messages, while the daemon
+# can't be reached or is busy
+FORWARD_INTERVAL = 1.0
+# Retries while forwarding, as for log_events
+FORWARD_RETRIES = 10
+FORWARD_WAIT = 0.1
+
+
+def enable(directory=None, max_bytes=SPOOL_MAX_BYTES):
+    """
+    Spool the messages log_event and log_events can't deliver under
+    @directory (by default, globus_cw_client-<uid> under SPOOL_DIR), up to
+    @max_bytes per process, and start forwarding any spool files left there
+    by processes which have exited.
+    """
+    if max_bytes < 1:
+        raise ValueError("max_bytes must be positive")
+    if directory is None:
+        directory = os.path.join(SPOOL_DIR, f"globus_cw_client-{os.getuid()}")
+    os.makedirs(directory, mode=0o700, exist_ok=True)
+    spool = _Spool(directory, max_bytes)
+    spool.start()
+    client._fallback = spool
+
+
+def disable():
+    """
+    Stop spooling messages. Messages already spooled are still forwarded.
+    """
+    client._fallback = None
+
+
+def flush(timeout=None):
+    """
+    Wait for up to @timeout seconds (forever if None) for this process's
+    spooled messages to be forwarded.
+    Returns: True if none are left
+    """
+    spool = client._fallback
+    if spool is None:
+        return True
+    return spool.flush(timeout)
+
+
+def _spooled_response(req, ack):
+    if not ack:
+        return None
+    if "messages" not in req:
+        return dict(status="spooled")
+    return dict(
+        status="spooled", results=[dict(status="spooled") for _ in req["messages"]]
+    )
+
+
+class _Spool:
+    """
+    A process's spool file, and the thread forwarding it.
+    The file holds a JSON line for each message, with its timestamp and
+    destination, as in a log_event request.
+    """
+
+    def __init__(self, directory, max_bytes):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self._reset()
+
+    def _reset(self):
+        # guards the state below, and is notified whenever it changes
+        self._cond = threading.Condition()
+        self._pid = os.getpid()
+        # opened on the first message spooled
+        self._file = None
+        self._path = None
+        # bytes written to the file, and forwarded from it; the file is
+        # truncated once they're equal
+        self._nr_written = 0
+        self._nr_forwarded = 0
+        self._thread = None
+
+    def start(self):
+        with self._cond:
+            if self._thread is None:
+                self._thread = threading.Thread(
+                    target=self._forward_main, name="cwlogger-fallback", daemon=True
+                )
+                self._thread.start()
+
+    def log(self, req, ack, send):
+        """
+        Deliver @req with @send(), or spool it if that fails for the daemon
+        being down or busy, or if earlier messages are still spooled.
+        Returns: the response to @req, with spooled messages given a
+                 "spooled" status; messages the daemon was too busy for, which
+                 the full spool can't take either, keep their "busy" status
+        """
+        self._check_pid()
+        with self._cond:
+            backlog = self._nr_written > self._nr_forwarded
+        if backlog:
+            return self._spool(req, ack, None)
+        try:
+            d = send()
+        except (client.CWLoggerConnectionError, client.CWLoggerDaemonBusyError) as err:
+            return self._spool(req, ack, err)
+        if d is not None and "messages" in req:
+            busy = [
+                (result, m)
+                for result, m in zip(d["results"], req["messages"])
+                if result["status"] == "busy"
+            ]
+            if busy:
+                try:
+                    self._spool(dict(req, messages=[m for _, m in busy]), ack, None)
+                except client.CWLoggerConnectionError:
+                    # raising would have the caller retry the messages which
+                    # were delivered, too
+                    return d
+                for result, _ in busy:
+                    result.clear()
+                    result["status"] = "spooled"
+        return d
+
+    def flush(self, timeout=None):
+        self._check_pid()
+        with self._cond:
+            return self._cond.wait_for(
+                lambda: self._nr_written == self._nr_forwarded, timeout=timeout
+            )
+
+    def _check_pid(self):
+        if self._pid == os.getpid():
+            return
+        # the file and its lock belong to the parent process; closing them
+        # here leaves the parent's lock held
+        if self._file is not None:
+            self._file.close()
+        self._reset()
+        self.start()
+
+    def _spool(self, req, ack, err):
+        """
+        Raise: @err, or CWLoggerConnectionError, if the spool file is full
+        """
+        messages = req["messages"] if "messages" in req else [req]
+        destination = req.get("destination")
+        lines = []
+        for m in messages:
+            if destination is not None:
+                m = dict(m, destination=destination)
+            lines.append(json.dumps(m) + "\n")
+        data = "".join(lines).encode("utf-8")
+
+        with self._cond:
+            if self._nr_written + len(data) > self.max_bytes:
+                if err is not None:
+                    raise err
+                raise client.CWLoggerConnectionError(
+                    "fallback spool full", self.directory
+                )
+            if self._file is None:
+                self._path, self._file = self._open()
+            self._file.write(data)
+            self._file.flush()
+            self._nr_written += len(data)
+            self._cond.notify_all()
+        return _spooled_response(req, ack)
+
+    def _open(self):
+        """
+        Returns: the path of a new spool file, and the file, locked and only
+                 then named so that other processes see it as in use
+        """
+        path = os.path.join(self.directory, f"{os.getpid()}-{int(time.time() * 1e9)}")
+        f = open(path, "ab")
+        fcntl.flock(f, fcntl.LOCK_EX)
+        os.rename(path, path + SPOOL_SUFFIX)
+        return path + SPOOL_SUFFIX, f
+
+    def _forward_main(self):
+        conn = client.CWLoggerConnection(FORWARD_RETRIES, FORWARD_WAIT)
+        try:
+            self._forward_orphans(conn)
+            while True:
+                with self._cond:
+                    self._cond.wait_for(lambda: self._nr_written > self._nr_forwarded)
+                    path = self._path
+                    start, end = self._nr_forwarded, self._nr_written
+                with open(path, "rb") as f:
+                    f.seek(start)
+                    data = f.read(end - start)
+                self._forward_lines(conn, data.splitlines())
+                with self._cond:
+                    self._nr_forwarded = end
+                    if self._nr_forwarded == self._nr_written:
+                        os.ftruncate(self._file.fileno(), 0)
+                        self._nr_written = self._nr_forwarded = 0
+                    self._cond.notify_all()
+        finally:
+            conn.close()
+
+    def _forward_orphans(self, conn):
+        """
+        Forward, then delete, the spool files under the directory which no
+        process holds a lock on
+        """
+        for name in sorted(os.listdir(self.directory)):
+            if not name.endswith(SPOOL_SUFFIX):
+                continue
+            try:
+                f = open(os.path.join(self.directory, name), "rb")
+            except FileNotFoundError:
+                # taken by another process
+                continue
+            with f:
+                try:
+                    fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except OSError as err:
+                    if err.errno != errno.EWOULDBLOCK:
+                        raise
+                    continue
+                if not os.path.exists(f.name):
+                    # forwarded and deleted by another process meanwhile
+                    continue
+                self._forward_lines(conn, f.read().splitlines())
+                os.unlink(f.name)
+
+    def _forward_lines(self, conn, lines):
+        """
+        Forward the spooled messages in @lines, in batches of consecutive
+        messages for the same destination, until the daemon has taken them
+        all. Messages which can't be parsed, or the daemon rejects, are
+        dropped.
+        """
+        batch = []
+        destination = None
+        for line in lines:
+            try:
+                m = json.loads(line)
+                message = dict(message=m["message"], timestamp=m["timestamp"])
+            except (ValueError, KeyError, TypeError):
+                # e.g. a line cut short by a crash
+                continue
+            if batch and (
+                m.get("destination") != destination or len(batch) >= FORWARD_BATCH
+            ):
+                self._forward(conn, batch, destination)
+                batch = []
+            destination = m.get("destination")
+            batch.append(message)
+        if batch:
+            self._forward(conn, batch, destination)
+
+    def _forward(self, conn, messages, destination):
+        req = dict(messages=messages)
+        if destination is not None:
+            req["destination"] = destination
+        while True:
+            try:
+                d = conn._request(req, FORWARD_RETRIES, FORWARD_WAIT)
+            except client.CWLoggerDaemonBusyError:
+                pass
+            except client.CWLoggerDaemonError:
+                # e.g. for a destination the daemon won't take
+                return
+            except Exception:
+                # CWLoggerConnectionError, or a garbled reply
+                conn.close()
+            else:
+                busy = [
+                    m
+                    for result, m in zip(d["results"], req["messages"])
+                    if result["status"] == "busy"
+                ]
+                if not busy:
+                    return
+                req = dict(req, messages=busy)
+            time.sleep(FORWARD_INTERVAL)
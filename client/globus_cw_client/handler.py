@@ -0,0 +1,213 @@
+"""
+A logging.Handler which sends records to the cwlogs daemon from a
+background thread, so that logging never waits on the daemon.
+"""
+import collections
+import logging
+import os
+import sys
+import threading
+
+from globus_cw_client.client import (
+    CWLoggerConnection,
+    _check_retry_args,
+    _make_destination,
+    _make_event_request,
+)
+
+# What emit() does with a record when the buffer is full:
+# wait for the sender to make room
+OVERFLOW_BLOCK = "block"
+# drop the oldest buffered record to make room
+OVERFLOW_DROP_OLDEST = "drop_oldest"
+# drop the new record
+OVERFLOW_DROP_NEWEST = "drop_newest"
+
+_OVERFLOW_POLICIES = (OVERFLOW_BLOCK, OVERFLOW_DROP_OLDEST, OVERFLOW_DROP_NEWEST)
+
+
+class CWLoggerHandler(logging.Handler):
+    """
+    Formats each record and adds it to a bounded in-memory buffer; a
+    background thread sends the buffered records to the daemon in batches,
+    over a persistent connection, stamped with the time they were logged.
+
+    Records the daemon rejects, or which can't be sent after retrying, are
+    dropped, as are records which overflow the buffer under a drop policy.
+    Drops are counted in the `dropped` attribute, and reported to the daemon
+    in a message of their own once it can be reached again.
+
+    close() sends the buffered records before returning, waiting for up to
+    @flush_timeout seconds; logging calls it for every handler at exit.
+
+    capacity: the most records to buffer
+    overflow: OVERFLOW_BLOCK, OVERFLOW_DROP_OLDEST or OVERFLOW_DROP_NEWEST
+    batch_size: the most records to send in one request
+    flush_timeout: the longest flush() and close() wait for the buffer to be
+                   sent
+    retries, wait, group_name, stream_name: as for
+        globus_cw_client.client.log_events
+    """
+
+    def __init__(
+        self,
+        level=logging.NOTSET,
+        capacity=10000,
+        overflow=OVERFLOW_BLOCK,
+        batch_size=500,
+        flush_timeout=5.0,
+        retries=10,
+        wait=0.1,
+        group_name=None,
+        stream_name=None,
+    ):
+        super().__init__(level)
+        if capacity < 1:
+            raise ValueError("capacity must be positive")
+        if overflow not in _OVERFLOW_POLICIES:
+            raise ValueError(f"overflow must be one of {_OVERFLOW_POLICIES}")
+        if batch_size < 1:
+            raise ValueError("batch_size must be positive")
+        _check_retry_args(retries, wait)
+        self.capacity = capacity
+        self.overflow = overflow
+        self.batch_size = batch_size
+        self.flush_timeout = flush_timeout
+        self.dropped = 0
+        self._retries = retries
+        self._retry_wait = wait
+        self._destination = _make_destination(group_name, stream_name)
+        self._start()
+
+    def _start(self):
+        # guards the buffer, and is notified whenever it changes
+        self._cond = threading.Condition()
+        # (timestamp, message) pairs
+        self._buffer = collections.deque()
+        # records taken from the buffer and not yet sent
+        self._nr_sending = 0
+        # drops not yet reported to the daemon
+        self._nr_unreported = 0
+        self._closed = False
+        self._pid = os.getpid()
+        # started on the first record, so that a handler made before a fork
+        # only sends from the process which uses it
+        self._thread = None
+
+    def emit(self, record):
+        try:
+            message = self.format(record)
+            timestamp = int(record.created * 1000)
+        except Exception:
+            self.handleError(record)
+            return
+
+        if self._pid != os.getpid():
+            # the buffer and sender belong to the parent process
+            self._start()
+        with self._cond:
+            if self._thread is None and not self._closed:
+                self._thread = threading.Thread(
+                    target=self._sender_main, name="cwlogger-handler", daemon=True
+                )
+                self._thread.start()
+            if len(self._buffer) >= self.capacity:
+                if self.overflow == OVERFLOW_BLOCK and not self._is_sender():
+                    while len(self._buffer) >= self.capacity and not self._closed:
+                        self._cond.wait()
+                elif self.overflow == OVERFLOW_DROP_OLDEST:
+                    self._buffer.popleft()
+                    self._count_dropped(1)
+            if self._closed or len(self._buffer) >= self.capacity:
+                self._count_dropped(1)
+                return
+            self._buffer.append((timestamp, message))
+            self._cond.notify_all()
+
+    def flush(self):
+        """
+        Wait for up to flush_timeout seconds for the buffered records to be
+        sent.
+        """
+        with self._cond:
+            self._cond.wait_for(
+                lambda: not (self._buffer or self._nr_sending) or self._is_sender(),
+                timeout=self.flush_timeout,
+            )
+
+    def close(self):
+        """
+        Send the buffered records, waiting for up to flush_timeout seconds,
+        and stop the sender. Records logged afterwards are dropped.
+        """
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+            thread = self._thread
+        if thread is not None and not self._is_sender():
+            thread.join(self.flush_timeout)
+        super().close()
+
+    def _is_sender(self):
+        return threading.current_thread() is self._thread
+
+    def _count_dropped(self, n):
+        with self._cond:
+            self.dropped += n
+            self._nr_unreported += n
+
+    def _sender_main(self):
+        conn = CWLoggerConnection(self._retries, self._retry_wait)
+        try:
+            while True:
+                with self._cond:
+                    self._cond.wait_for(lambda: self._buffer or self._closed)
+                    if not self._buffer:
+                        return
+                    n = min(self.batch_size, len(self._buffer))
+                    batch = [self._buffer.popleft() for _ in range(n)]
+                    nr_unreported, self._nr_unreported = self._nr_unreported, 0
+                    self._nr_sending = n
+                    self._cond.notify_all()
+                try:
+                    self._send(conn, batch, nr_unreported)
+                finally:
+                    with self._cond:
+                        self._nr_sending = 0
+                        self._cond.notify_all()
+        finally:
+            conn.close()
+
+    def _send(self, conn, batch, nr_unreported):
+        events = [_make_event_request(m, timestamp=t) for t, m in batch]
+        if nr_unreported:
+            events.insert(
+                0,
+                _make_event_request(f"CWLoggerHandler dropped {nr_unreported} records"),
+            )
+        req = dict(messages=events)
+        if self._destination is not None:
+            req["destination"] = self._destination
+
+        try:
+            d = conn._request(req, self._retries, self._retry_wait)
+        except Exception as err:
+            # CWLoggerError, or a garbled reply; either way, keep sending
+            self._count_dropped(len(batch))
+            with self._cond:
+                # report the earlier drops with these, next time
+                self._nr_unreported += nr_unreported
+            _report_error(f"could not send {len(batch)} records: {err!r}")
+            return
+        results = d["results"][1:] if nr_unreported else d["results"]
+        nr_failed = sum(1 for result in results if result["status"] != "ok")
+        if nr_failed:
+            self._count_dropped(nr_failed)
+            _report_error(f"daemon rejected {nr_failed} records")
+
+
+def _report_error(message):
+    # as logging.Handler.handleError does, only when logging.raiseExceptions
+    # is set; logging it would only add more records to send
+    if logging.raiseExceptions and sys.stderr:
+        sys.stderr.write(f"--- CWLoggerHandler error ---\n{message}\n")
@@ -0,0 +1,177 @@
+"""
+Upload the events kept by the daemon's file sink (see sinks.FileSink) to
+CloudWatch Logs, e.g. once uploads work again after the sink took them as a
+fallback.
+
+Each rotated file is uploaded to the log group and stream it was written
+for, with the AWS settings in /etc/cwlogd.ini, and then deleted, unless
+some of its events couldn't be uploaded, which keeps it. Events
+which AWS would discard, older than cwlogs.MAX_EVENT_AGE_DAYS or more than
+cwlogs.MAX_EVENT_AHEAD_HOURS in the future, are skipped and counted.
+
+Usage: globus_cw_daemon_backfill [--dir DIR] [--include-current] [--keep]
+                                 [--dry-run]
+"""
+import argparse
+import gzip
+import json
+import logging
+import os
+import sys
+import time
+import urllib.parse
+
+import globus_cw_daemon.config as config
+import globus_cw_daemon.cwlogs as cwlogs
+import globus_cw_daemon.sinks as sinks
+
+_log = logging.getLogger(__name__)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Upload the events kept by the daemon's file sink."
+    )
+    parser.add_argument(
+        "--dir",
+        help="The file sink directory. Default is file_sink_dir in /etc/cwlogd.ini.",
+    )
+    parser.add_argument(
+        "--include-current",
+        action="store_true",
+        help="Also upload the files the daemon is writing to, which it "
+        "otherwise rotates after file_sink_max_age_secs. Only use this while "
+        "the daemon is stopped.",
+    )
+    parser.add_argument(
+        "--keep", action="store_true", help="Don't delete files once uploaded."
+    )
+    parser.add_argument(
+        "--dry-run",
+        action="store_true",
+        help="Only count the events which would be uploaded.",
+    )
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+
+    root = args.dir
+    if root is None:
+        try:
+            root = config.get_string("file_sink_dir")
+        except KeyError:
+            sys.exit("no file_sink_dir found in /etc/cwlogd.ini, use --dir")
+
+    writers = {}
+    nr_kept = 0
+    for group_name, stream_name, path in _sink_files(root, args.include_current):
+        events, nr_skipped = read_events(path)
+        _log.info(
+            "%s: %d events for %s %s, %d outside the AWS acceptance window",
+            path,
+            len(events),
+            group_name,
+            stream_name,
+            nr_skipped,
+        )
+        if args.dry_run:
+            continue
+        if events:
+            writer = writers.get((group_name, stream_name))
+            if writer is None:
+                writer = writers[(group_name, stream_name)] = _make_writer(
+                    group_name, stream_name
+                )
+            nr_failed = writer.upload_events(events)
+            if nr_failed:
+                _log.error("%s: %d events not uploaded, keeping it", path, nr_failed)
+                nr_kept += 1
+                continue
+        if not args.keep:
+            os.unlink(path)
+    if nr_kept:
+        sys.exit(f"{nr_kept} files not fully uploaded, kept")
+
+
+def _make_writer(group_name, stream_name):
+    """
+    Returns: a LogWriter for the destination, uploading as the daemon does
+    """
+    try:
+        aws_region = config.get_string("aws_region")
+    except KeyError:
+        aws_region = None
+    try:
+        endpoint_url = config.get_string("endpoint_url")
+    except KeyError:
+        endpoint_url = None
+    try:
+        nr_streams = config.get_int("upload_streams")
+    except KeyError:
+        nr_streams = 1
+    try:
+        compress = config.get_bool("compress_uploads")
+    except KeyError:
+        compress = False
+    return cwlogs.LogWriter(
+        group_name,
+        stream_name,
+        aws_region=aws_region,
+        nr_streams=nr_streams,
+        endpoint_url=endpoint_url,
+        compress=compress,
+    )
+
+
+def _sink_files(root, include_current=False):
+    """
+    Yields: (group_name, stream_name, path) for each file under @root, oldest
+            first for each destination
+    """
+    for group_dir in sorted(os.listdir(root)):
+        for stream_dir in sorted(os.listdir(os.path.join(root, group_dir))):
+            path = os.path.join(root, group_dir, stream_dir)
+            names = sorted(
+                name for name in os.listdir(path) if name.endswith(sinks.ROTATED_SUFFIX)
+            )
+            if include_current and sinks.CURRENT_FILE in os.listdir(path):
+                names.append(sinks.CURRENT_FILE)
+            for name in names:
+                yield (
+                    urllib.parse.unquote(group_dir),
+                    urllib.parse.unquote(stream_dir),
+                    os.path.join(path, name),
+                )
+
+
+def read_events(path, now=None):
+    """
+    Read the events of the file sink file at @path, gzip'd or not.
+    Returns: the Events which AWS would accept at @now (ms, by default the
+             current time), and the number of others skipped
+    """
+    if now is None:
+        now = int(time.time() * 1000)
+    oldest = now - cwlogs.MAX_EVENT_AGE_DAYS * 24 * 3600 * 1000
+    newest = now + cwlogs.MAX_EVENT_AHEAD_HOURS * 3600 * 1000
+    opener = gzip.open if path.endswith(".gz") else open
+    events = []
+    nr_skipped = 0
+    with opener(path, "rb") as f:
+        for line in f:
+            try:
+                d = json.loads(line)
+                timestamp = d["timestamp"]
+                if not oldest < timestamp < newest:
+                    nr_skipped += 1
+                    continue
+                events.append(
+                    cwlogs.Event(timestamp, d["message"], enforce_limit=False)
+                )
+            except Exception as e:
+                # e.g. a line cut short by a crash
+                _log.error("skipping bad line in %s: %r", path, e)
+    return events, nr_skipped
+
+
+if __name__ == "__main__":
+    main()
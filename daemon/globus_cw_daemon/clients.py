@@ -0,0 +1,208 @@
+"""
+Per-client rate limits and fair queuing.
+
+Clients are told apart by the credentials of their end of the socket: the
+pid or uid from SO_PEERCRED for connections, or from SCM_CREDENTIALS for
+datagrams. Each client's events are limited by a token bucket, and queued in
+memory in a queue of their own, which are drained round robin, so that one
+chatty client can neither fill the queue nor hold up the events of others.
+"""
+import collections
+import socket
+import struct
+import time
+
+# What identifies a client, unless overridden by client_key in /etc/cwlogd.ini
+CLIENT_KEYS = ("pid", "uid")
+CLIENT_KEY = "pid"
+
+# Unless overridden by client_rate_burst in /etc/cwlogd.ini, a client may
+# send this many seconds' worth of events at once
+RATE_BURST_SECS = 10
+
+# struct ucred: pid, uid, gid
+_UCRED = struct.Struct("3i")
+
+# Ancillary data needed to receive a datagram's credentials
+CREDENTIALS_BUFSIZE = socket.CMSG_SPACE(_UCRED.size)
+
+
+def peer_client(sock, key=CLIENT_KEY):
+    """
+    Returns: the client at the other end of the connected @sock, by @key,
+             or None if it can't be told
+    """
+    try:
+        creds = sock.getsockopt(socket.SOL_SOCKET, socket.SO_PEERCRED, _UCRED.size)
+    except OSError:
+        return None
+    return _client(_UCRED.unpack(creds), key)
+
+
+def datagram_client(ancdata, key=CLIENT_KEY):
+    """
+    @ancdata: the ancillary data of a datagram received with recvmsg from a
+              socket with SO_PASSCRED set
+    Returns: the client which sent it, by @key, or None if it can't be told
+    """
+    for level, type, data in ancdata:
+        if level == socket.SOL_SOCKET and type == socket.SCM_CREDENTIALS:
+            return _client(_UCRED.unpack(data[: _UCRED.size]), key)
+    return None
+
+
+def _client(creds, key):
+    pid, uid, _ = creds
+    return pid if key == "pid" else uid
+
+
+class _TokenBucket:
+    def __init__(self, rate, burst, now):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = float(burst)
+        self.updated = now
+
+    def refill(self, now):
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+
+class RateLimiter:
+    """
+    A token bucket for each client, refilled at @rate events per second, up
+    to @burst events.
+    Not thread-safe; callers must serialize access.
+    """
+
+    def __init__(self, rate, burst):
+        if rate <= 0 or burst < 1:
+            raise ValueError("rate and burst must be positive")
+        self.rate = rate
+        self.burst = burst
+        self._buckets = {}
+
+    def take(self, client, nr_events):
+        """
+        Returns: how many of @nr_events from @client are allowed, in order
+        """
+        now = time.monotonic()
+        bucket = self._buckets.get(client)
+        if bucket is None:
+            bucket = self._buckets[client] = _TokenBucket(self.rate, self.burst, now)
+        else:
+            bucket.refill(now)
+        nr_allowed = min(nr_events, int(bucket.tokens))
+        bucket.tokens -= nr_allowed
+        return nr_allowed
+
+    def prune(self):
+        """
+        Forget clients whose buckets have refilled, which a new bucket
+        would be the same as
+        """
+        now = time.monotonic()
+        for client, bucket in list(self._buckets.items()):
+            bucket.refill(now)
+            if bucket.tokens >= bucket.burst:
+                del self._buckets[client]
+
+
+class ClientQueues:
+    """
+    Events queued in memory, in a FIFO queue for each client.
+    Each client's events are counted against its share from when they're
+    queued until they're released, after being uploaded.
+    Not thread-safe; callers must serialize access.
+    """
+
+    def __init__(self):
+        # client -> deque of events, in the order they're next drained in
+        self._queues = collections.OrderedDict()
+        # client -> bytes of its events, queued or drained but not released
+        self._held_bytes = {}
+        self.nr_events = 0
+        self.nr_bytes = 0
+
+    def __len__(self):
+        return self.nr_events
+
+    def share(self, client, max_events, max_bytes):
+        """
+        Each client may fill its fair share of a queue of @max_events and
+        @max_bytes: all of it while no other client has events held, else an
+        equal part, among the clients with events held, with a part kept
+        back for one more client, so that a newcomer doesn't find the queue
+        full of others' events.
+        Returns: the events and bytes which @client may still queue
+        """
+        nr_held_bytes = self._held_bytes.get(client)
+        nr_others = len(self._held_bytes) - (nr_held_bytes is not None)
+        nr_parts = nr_others + 2 if nr_others else 1
+        queue = self._queues.get(client, ())
+        return (
+            max(0, max_events // nr_parts - len(queue)),
+            max(0, max_bytes // nr_parts - (nr_held_bytes or 0)),
+        )
+
+    def extend(self, client, events, nr_bytes):
+        """
+        Queue @events from @client, which total @nr_bytes
+        """
+        if not events:
+            return
+        queue = self._queues.get(client)
+        if queue is None:
+            queue = self._queues[client] = collections.deque()
+        queue.extend(events)
+        self._held_bytes[client] = self._held_bytes.get(client, 0) + nr_bytes
+        self.nr_events += len(events)
+        self.nr_bytes += nr_bytes
+
+    def drain(self, max_bytes=None):
+        """
+        Take up to about @max_bytes of events (all of them if None), round
+        robin, with each client's events taken oldest first. The next drain
+        carries on the rotation where this one stopped.
+        Returns: the events taken, and the bytes taken from each client, to
+                 release() once they're uploaded
+        """
+        if len(self._queues) == 1 and (max_bytes is None or self.nr_bytes <= max_bytes):
+            # nothing to be fair between, nor to leave behind
+            client, queue = self._queues.popitem()
+            taken = {client: self.nr_bytes}
+            self.nr_events = 0
+            self.nr_bytes = 0
+            return list(queue), taken
+        if max_bytes is None or self.nr_bytes <= max_bytes:
+            max_bytes = self.nr_bytes
+        events = []
+        taken = {}
+        # each client takes at least one event per turn
+        quantum = max(1, max_bytes // max(1, len(self._queues)))
+        nr_taken = 0
+        while self._queues and (nr_taken < max_bytes or not events):
+            client, queue = next(iter(self._queues.items()))
+            nr_turn = 0
+            while queue and nr_turn < quantum:
+                event = queue.popleft()
+                events.append(event)
+                nr_turn += event.size_in_bytes
+            nr_taken += nr_turn
+            taken[client] = taken.get(client, 0) + nr_turn
+            if queue:
+                self._queues.move_to_end(client)
+            else:
+                del self._queues[client]
+        self.nr_events -= len(events)
+        self.nr_bytes -= nr_taken
+        return events, taken
+
+    def release(self, taken):
+        """
+        Stop counting the bytes @taken by drain() against each client's share
+        """
+        for client, nr_bytes in taken.items():
+            self._held_bytes[client] -= nr_bytes
+            if not self._held_bytes[client] and client not in self._queues:
+                del self._held_bytes[client]
@@ -3,20 +3,100 @@ Upload logs to cloudwatch.
 - log records too old are discarded by AWS (tooOldLogEventEndIndex)
 - log records in the future are discarded by AWS (tooNewLogEventStartIndex)
 """
+import functools
+import gzip
+import json
 import logging
+import operator
+import queue
+import random
+import threading
 import time
 
 import boto3
+import botocore.config
+import botocore.exceptions
+
+import globus_cw_daemon.metrics as metrics
 
 MAX_EVENT_BYTES = 256 * 1024
 
-# These make our batches conform to the AWS API
-MAX_BATCH_BYTES = 800000  # Officially 1MB
-MAX_BATCH_RECORDS = 5000  # Officially 10,000
-MAX_BATCH_RANGE_HOURS = 6  # Officially 24 hours
+# The AWS API limits on a batch, with event sizes counted as AWS counts them
+MAX_BATCH_BYTES = 1024 * 1024
+MAX_BATCH_RECORDS = 10000
+MAX_BATCH_RANGE_HOURS = 24
+_MAX_BATCH_RANGE_MS = MAX_BATCH_RANGE_HOURS * 3600 * 1000
+
+# AWS discards events older than this, or further than this in the future
+MAX_EVENT_AGE_DAYS = 14
+MAX_EVENT_AHEAD_HOURS = 2
+
+# Each LogWriter is a pipeline: submitted events wait to be batched, and the
+# batches, serialized, wait to be uploaded. Each stage waits while the next
+# one's queue is full: at most this many submissions, and this many batches
+# per upload thread.
+PIPELINE_SUBMISSIONS = 2
+PIPELINE_BATCHES_PER_THREAD = 2
+
+# A stage waiting this long on the next logs a warning, and again as often
+STALL_WARNING_SECS = 10
+
+# Compressed uploads favour speed; repetitive JSON compresses well regardless
+GZIP_LEVEL = 1
+
+# Errors which mean the service doesn't accept a gzip'd body
+_GZIP_REJECTED_CODES = ("SerializationException", "UnsupportedMediaTypeException")
+
+# How failed uploads are retried, by class of error (see _classify_error):
+# (first backoff, max backoff) in seconds, backing off exponentially with full
+# jitter, or None to give up on the batch. The stream is created again
+# before retrying "missing" errors, in case it was deleted, and the batch
+# given up on if that fails for the log group being missing too. "invalid"
+# batches, which the service refused for a reason it doesn't name, are split
+# in two and each half uploaded, giving up only on single events.
+RETRY_POLICIES = {
+    "throttled": (1.0, 30.0),
+    "transient": (0.5, 20.0),
+    "auth": (5.0, 60.0),
+    "missing": (5.0, 60.0),
+    "invalid": None,
+    "permanent": None,
+}
+
+_THROTTLED_CODES = (
+    "ThrottlingException",
+    "Throttling",
+    "TooManyRequestsException",
+    "RequestLimitExceeded",
+    "LimitExceededException",
+)
+# Errors which retrying can't fix; AccessDeniedException is the IAM policy
+# denying the log group, rather than a problem with the credentials
+_PERMANENT_CODES = ("AccessDeniedException",)
+_AUTH_CODES = (
+    "UnrecognizedClientException",
+    "ExpiredTokenException",
+    "ExpiredToken",
+    "InvalidSignatureException",
+    "RequestExpired",
+)
+_CREDENTIAL_ERRORS = (
+    botocore.exceptions.NoCredentialsError,
+    botocore.exceptions.PartialCredentialsError,
+    botocore.exceptions.CredentialRetrievalError,
+)
+_NETWORK_ERRORS = (
+    botocore.exceptions.ConnectionError,
+    botocore.exceptions.HTTPClientError,
+    ConnectionError,
+    TimeoutError,
+)
 
 _log = logging.getLogger(__name__)
 
+# The PutLogEvents body for the current thread's call, see _use_prepared_body
+_prepared = threading.local()
+
 
 class InvalidMessage(Exception):
     pass
@@ -31,92 +111,453 @@ def _add_emf_header(request, **kwargs):
     request.headers.add_header("x-amzn-logs-format", "json/emf")
 
 
+def _use_prepared_body(params, **kwargs):
+    """
+    Replace the PutLogEvents body serialized by botocore with the one prepared
+    by _StreamWriter, which embeds the JSON of each message as-is
+    """
+    body = getattr(_prepared, "body", None)
+    if body is not None:
+        params["body"] = body
+        _prepared.body = None
+    if getattr(_prepared, "gzip", False):
+        _gzip_body(params)
+
+
+# Times gzip'ing for gzip_cpu_seconds; before python3.7, which has no
+# per-thread CPU clock, the wall clock stands in
+_gzip_clock = getattr(time, "thread_time", time.perf_counter)
+
+
+def _gzip_body(params):
+    """
+    Compress the request body of @params, recording the bytes saved and the
+    CPU time spent
+    """
+    body = params["body"]
+    if isinstance(body, str):
+        body = body.encode("utf-8")
+    start = _gzip_clock()
+    compressed = gzip.compress(body, compresslevel=GZIP_LEVEL)
+    metrics.gzip_cpu_seconds.inc(_gzip_clock() - start)
+    metrics.gzip_input_bytes.inc(len(body))
+    metrics.gzip_output_bytes.inc(len(compressed))
+    params["body"] = compressed
+    params["headers"]["Content-Encoding"] = "gzip"
+
+
 class Event:
-    def __init__(self, timestamp, message, enforce_limit=True):
+    # queues hold many events, so they have no per-instance __dict__
+    __slots__ = ("timestamp", "_message", "_json_message", "size_in_bytes")
+
+    def __init__(self, timestamp, message, enforce_limit=True, json_message=None):
         """
-        Raise: InvalidMessage if message is too long
+        @json_message: optionally, the JSON encoding of @message as utf8 bytes.
+        If about as compact, it is kept instead of @message, and uploaded
+        without being decoded and encoded again.
+        Raise: InvalidMessage if message is empty or too long
         Raise: UnicodeDecodeError if message is not valid utf8
         """
         if isinstance(message, bytes):
+            size = len(message)
             message = message.decode("utf-8")
+        else:
+            _checktype(message, str, "message must be an str")
+            size = _utf8_len(message)
+        if not size:
+            # PutLogEvents requires at least one character
+            raise InvalidMessage("message is empty")
         if timestamp is None:
             timestamp = int(time.time() * 1000)
-        _checktype(message, str, "message must be an str")
         _checktype(timestamp, int, "timestamp must be an int")
         if timestamp < 0:
             raise ValueError("Event.timestamp must be non-negative")
-        encoded_message = message.encode("utf-8")
         self.timestamp = timestamp
-        self.unicode_message = message
-        self.size_in_bytes = len(encoded_message) + 26
+        if json_message is not None and len(json_message) <= size + size // 8 + 2:
+            self._message = None
+            self._json_message = json_message
+        else:
+            self._message = message
+            self._json_message = None
+        self.size_in_bytes = size + 26
         if self.size_in_bytes > MAX_EVENT_BYTES and enforce_limit:
             raise InvalidMessage("message too large")
 
+    @property
+    def unicode_message(self):
+        if self._message is None:
+            return json.loads(self._json_message)
+        return self._message
+
+    @property
+    def json_message(self):
+        if self._json_message is None:
+            return json.dumps(self._message).encode("utf-8")
+        return self._json_message
+
+
+# str.isascii needs python3.7
+_HAS_ISASCII = hasattr(str, "isascii")
+
+
+def _utf8_len(message):
+    """
+    The length of @message encoded as utf8, without encoding ascii messages
+    """
+    if _HAS_ISASCII and message.isascii():
+        return len(message)
+    return len(message.encode("utf-8"))
+
 
 class _Batch:
+    __slots__ = ("nr_bytes", "records", "records_json")
+
     def __init__(self):
         self.nr_bytes = 0
         self.records = []
+        # set by the batching stage, so that uploads needn't serialize
+        self.records_json = None
 
     def add(self, record):
         """
         Return True if record was added to this batch, otherwise False
-        Prereq: records are in timestamp order
+        Prereq: records are added in timestamp order
         """
-        _checktype(record, Event, "batch records must be Events")
-
-        if len(self.records) >= MAX_BATCH_RECORDS:
+        records = self.records
+        if records and (
+            len(records) >= MAX_BATCH_RECORDS
+            or record.timestamp - records[0].timestamp >= _MAX_BATCH_RANGE_MS
+        ):
             return False
-
-        if self.records:
-            if self.time_diff_exceeded(self.records[0], record):
-                return False
-
-        if (self.nr_bytes + record.size_in_bytes) >= MAX_BATCH_BYTES:
+        if self.nr_bytes + record.size_in_bytes > MAX_BATCH_BYTES:
             return False
 
-        self.records.append(record)
+        records.append(record)
         self.nr_bytes += record.size_in_bytes
         return True
 
-    def get_records_for_boto(self):
-        ret = []
-        for r in self.records:
-            ret.append(dict(timestamp=r.timestamp, message=r.unicode_message))
-        return ret
-
-    @staticmethod
-    def time_diff_exceeded(a, b):
-        diff_ms = b.timestamp - a.timestamp
-        if diff_ms < 0:
-            raise ValueError(
-                "checking timestamp diff in record batch got negative diff"
+    def get_records_json(self):
+        """
+        Returns: the JSON array of log events for PutLogEvents, as utf8 bytes
+        """
+        return (
+            b"["
+            + b", ".join(
+                b'{"timestamp": %d, "message": %s}' % (r.timestamp, r.json_message)
+                for r in self.records
             )
-        return diff_ms >= (3600 * MAX_BATCH_RANGE_HOURS * 1000)
+            + b"]"
+        )
 
 
 class LogWriter:
-    def __init__(self, group_name, stream_name, aws_region=None):
+    def __init__(
+        self,
+        group_name,
+        stream_name,
+        aws_region=None,
+        nr_streams=1,
+        endpoint_url=None,
+        compress=False,
+        sequence_tokens=False,
+        nr_threads=None,
+        fallback=None,
+        fallback_secs=None,
+    ):
         """
         Create the @stream_name if it doesn't exist.
+        If @nr_streams is more than 1, events are instead sharded across the
+        streams <stream_name>-0 .. <stream_name>-<nr_streams - 1>.
+        Events submitted are batched and serialized by one thread, while
+        @nr_threads threads (by default, one per stream) upload the batches
+        concurrently, dealt out to the streams in turn.
+        If @sequence_tokens, uploads pass sequence tokens, as PutLogEvents
+        once required, and only one batch at a time is uploaded to a stream.
+        @endpoint_url overrides the CloudWatch Logs endpoint, e.g. to use a
+        local stand-in for benchmarks.
+        If @compress, PutLogEvents bodies are gzip'd, until the service
+        rejects one.
+        If @fallback is given, a batch whose uploads have failed for
+        @fallback_secs, or which failed with a permanent error, is passed to
+        fallback(group_name, stream_name, events), and given up on if that
+        returns True; @stream_name is passed as given, even if sharded.
         Raise: exception if boto can't connect.
         """
         _log.info("LogWriter init, %s, %s", group_name, stream_name)
+        if nr_streams < 1:
+            raise ValueError("nr_streams must be positive")
+        if nr_threads is None or sequence_tokens:
+            nr_threads = nr_streams
+        if nr_threads < 1:
+            raise ValueError("nr_threads must be positive")
 
         # Keep a connection around for performance.  boto is smart enough
         # to refresh role creds right before they expire (see provider.py).
-        self.client = boto3.client("logs", region_name=(aws_region or "us-east-1"))
+        # boto3 clients are thread-safe, so all streams share this one.
+        self.client = boto3.client(
+            "logs",
+            region_name=(aws_region or "us-east-1"),
+            endpoint_url=endpoint_url,
+            config=botocore.config.Config(max_pool_connections=max(10, nr_threads)),
+        )
         self.client.meta.events.register(
             "before-sign.cloudwatch-logs.PutLogEvents", _add_emf_header
         )
+        self.client.meta.events.register(
+            "before-call.cloudwatch-logs.PutLogEvents", _use_prepared_body
+        )
 
+        self.group_name = group_name
+        if nr_streams == 1:
+            stream_names = [stream_name]
+        else:
+            stream_names = [f"{stream_name}-{i}" for i in range(nr_streams)]
+        self.streams = [
+            _StreamWriter(
+                self.client,
+                group_name,
+                name,
+                compress=compress,
+                sequence_tokens=sequence_tokens,
+                fallback=(
+                    functools.partial(fallback, group_name, stream_name)
+                    if fallback
+                    else None
+                ),
+                fallback_secs=fallback_secs,
+            )
+            for name in stream_names
+        ]
+        self.sequence_tokens = sequence_tokens
+
+        # the stream which gets the next batch
+        self._next_stream = 0
+        self._submissions = queue.Queue(PIPELINE_SUBMISSIONS)
+        self._batches = queue.Queue(PIPELINE_BATCHES_PER_THREAD * nr_threads)
+        # protects the count of batches left in each submission
+        self._done_lock = threading.Lock()
+        batch_thread = threading.Thread(target=self._batch_main, name="cwlogs-batch")
+        batch_thread.daemon = True
+        batch_thread.start()
+        self._nr_upload_threads = 0
+        self.grow_upload_threads(nr_threads)
+
+    @property
+    def nr_submissions_waiting(self):
+        return self._submissions.qsize()
+
+    @property
+    def nr_batches_waiting(self):
+        return self._batches.qsize()
+
+    def grow_upload_threads(self, nr_threads):
+        """
+        Start upload threads until there are @nr_threads, e.g. to upload as
+        fast as possible at shutdown. Does nothing if uploads pass sequence
+        tokens, once there's one thread per stream.
+        """
+        if self.sequence_tokens and self._nr_upload_threads:
+            return
+        while self._nr_upload_threads < nr_threads:
+            thread = threading.Thread(
+                target=self._upload_main,
+                name=f"cwlogs-upload-{self._nr_upload_threads}",
+            )
+            thread.daemon = True
+            thread.start()
+            self._nr_upload_threads += 1
+
+    def submit(self, events, on_done=None):
+        """
+        Queue @events to be batched and uploaded, waiting while the pipeline
+        is full. Once every event is uploaded (or dropped after a permanent
+        error), @on_done is called from an upload thread.
+        """
+        _put(self._submissions, _Submission(events, on_done), "submit")
+
+    def upload_events(self, events):
+        """
+        Upload @events, waiting until done
+        Returns: the number of events which weren't uploaded, having been
+                 dropped after a permanent error or passed to the fallback
+        """
+        done = threading.Event()
+        submission = _Submission(events, done.set)
+        _put(self._submissions, submission, "submit")
+        done.wait()
+        return submission.nr_failed
+
+    def close(self):
+        """
+        Stop the batching and upload threads once they're done with the
+        events already submitted; no more may be submitted
+        """
+        self._submissions.put(None)
+
+    def _batch_main(self):
+        while True:
+            submission = self._submissions.get()
+            if submission is None:
+                for _ in range(self._nr_upload_threads):
+                    self._batches.put(None)
+                return
+            try:
+                batches = _make_batches(submission.events)
+                for batch in batches:
+                    batch.records_json = batch.get_records_json()
+            except Exception:
+                _log.exception("error batching %d events", len(submission.events))
+                submission.nr_failed = len(submission.events)
+                batches = []
+            # the events are held by the batches from here on
+            submission.events = None
+            if not batches:
+                submission.finish()
+                continue
+
+            submission.nr_batches = len(batches)
+            for batch in batches:
+                stream = self.streams[self._next_stream]
+                self._next_stream = (self._next_stream + 1) % len(self.streams)
+                _put(self._batches, (stream, batch, submission), "batch")
+
+    def _upload_main(self):
+        while True:
+            item = self._batches.get()
+            if item is None:
+                return
+            stream, batch, submission = item
+            try:
+                nr_failed = stream.upload_batch(batch)
+            except Exception:
+                _log.exception("error uploading %d events", len(batch.records))
+                nr_failed = len(batch.records)
+            with self._done_lock:
+                submission.nr_failed += nr_failed
+                submission.nr_batches -= 1
+                done = not submission.nr_batches
+            if done:
+                submission.finish()
+
+
+class _Submission:
+    __slots__ = ("events", "on_done", "nr_batches", "nr_failed")
+
+    def __init__(self, events, on_done):
+        self.events = events
+        self.on_done = on_done
+        # batches not yet uploaded
+        self.nr_batches = 0
+        # events which weren't uploaded
+        self.nr_failed = 0
+
+    def finish(self):
+        if self.on_done is None:
+            return
+        try:
+            self.on_done()
+        except Exception:
+            _log.exception("error finishing upload")
+
+
+def _put(q, item, stage):
+    """
+    Put @item on the next stage's queue @q, waiting while it's full; time
+    spent waiting is counted as the backpressure on @stage as it goes, so
+    that a stuck upload shows in metrics while it's stuck
+    """
+    try:
+        q.put_nowait(item)
+        return
+    except queue.Full:
+        pass
+    start = last = time.monotonic()
+    next_warning = start + STALL_WARNING_SECS
+    while True:
+        try:
+            q.put(item, timeout=1)
+            return
+        except queue.Full:
+            pass
+        finally:
+            now = time.monotonic()
+            metrics.pipeline_blocked_seconds.inc(now - last, label_value=stage)
+            last = now
+        if now >= next_warning:
+            _log.warning("%s stage waiting on uploads for %.0fs", stage, now - start)
+            next_warning = now + STALL_WARNING_SECS
+
+
+def _make_batches(events):
+    """
+    Pack @events into as few batches as the AWS limits allow, each in
+    timestamp order, with events of equal timestamps kept in queue order
+    """
+    batches = []
+    batch = None
+    for event in _in_timestamp_order(events):
+        if batch is None or not batch.add(event):
+            batch = _Batch()
+            batch.add(event)
+            batches.append(batch)
+    return batches
+
+
+def _in_timestamp_order(events):
+    """
+    Returns: @events, sorted by timestamp
+    The queue is almost always in order already, which takes one pass to
+    check; otherwise, the sort merges the ordered runs it finds.
+    """
+    last = -1
+    for event in events:
+        if event.timestamp < last:
+            return sorted(events, key=_timestamp)
+        last = event.timestamp
+    return events
+
+
+_timestamp = operator.attrgetter("timestamp")
+
+
+class _StreamWriter:
+    """
+    Uploads batches to one log stream, and if @sequence_tokens, tracks its
+    sequence token; otherwise, batches can be uploaded from many threads
+    at once
+    """
+
+    def __init__(
+        self,
+        client,
+        group_name,
+        stream_name,
+        compress=False,
+        sequence_tokens=False,
+        fallback=None,
+        fallback_secs=None,
+    ):
+        """
+        Create the @stream_name if it doesn't exist.
+        @fallback(events), if given, takes batches failing for @fallback_secs
+        or with permanent errors, as for LogWriter
+        """
+        self.client = client
         self.group_name = group_name
         self.stream_name = stream_name
+        self.compress = compress
+        self.sequence_tokens = sequence_tokens
+        self.fallback = fallback
+        self.fallback_secs = fallback_secs or 0
+        # only used with sequence_tokens:
         # on the first call to a new log stream, this *must* be omitted
         # on an existing stream, leaving it out will trigger an
         # InvalidSequenceToken error, which we handle
         self.sequence_token = None
+        self._token_lock = threading.Lock()
+        self._create_stream()
 
+    def _create_stream(self):
         try:
             self.client.create_log_stream(
                 logGroupName=self.group_name, logStreamName=self.stream_name
@@ -124,45 +565,72 @@ class LogWriter:
         except self.client.exceptions.ResourceAlreadyExistsException:
             pass
 
-    def upload_events(self, events):
-        events = list(events)
-        events.sort(key=lambda x: x.timestamp, reverse=True)
-        while events:
-            batch = _Batch()
-            while events:
-                event = events[-1]
-                if not batch.add(event):
-                    break
-                events.pop()
-
-            _log.debug(
-                "flushing batch, bytes=%d, recs=%d", batch.nr_bytes, len(batch.records)
-            )
-            self._flush_events(batch.get_records_for_boto())
+    def upload_batch(self, batch):
+        """
+        Returns: the number of events of @batch which weren't uploaded, having
+                 been dropped or passed to the fallback
+        """
+        _log.debug(
+            "flushing batch, stream=%s, bytes=%d, recs=%d",
+            self.stream_name,
+            batch.nr_bytes,
+            len(batch.records),
+        )
+        if self.sequence_tokens:
+            # each token allows just one upload to the stream at a time
+            with self._token_lock:
+                return self._flush_events(batch)
+        return self._flush_events(batch)
 
-    def _flush_events(self, events):
+    def _flush_events(self, batch):
         """
         Upload a single batch of events.
-        All exceptions are retried forever.
+        Errors are retried forever as RETRY_POLICIES says, except for
+        permanent ones, which drop the batch, unless there's a fallback to
+        take it instead.
+        Returns: the number of events which weren't uploaded
         """
-        if not len(events):
+        if not len(batch.records):
             raise ValueError("cannot flush with no events")
+        records_json = batch.records_json
+        if records_json is None:
+            records_json = batch.get_records_json()
+        # botocore only validates and serializes this stand-in for the events,
+        # the body sent is swapped for a prepared one by _use_prepared_body;
+        # Event checks the real ones as botocore would
+        stand_in = [dict(timestamp=batch.records[0].timestamp, message="-")]
+        nr_failures = 0
+        failing_since = None
         while True:
             try:
                 kwargs = dict(
                     logGroupName=self.group_name,
                     logStreamName=self.stream_name,
-                    logEvents=events,
+                    logEvents=stand_in,
                 )
                 if self.sequence_token:
                     kwargs["sequenceToken"] = self.sequence_token
-                ret = self.client.put_log_events(**kwargs)
+                _prepared.body = _put_log_events_body(kwargs, records_json)
+                _prepared.gzip = self.compress
+                start = time.monotonic()
+                try:
+                    ret = self.client.put_log_events(**kwargs)
+                finally:
+                    _prepared.body = None
+                    _prepared.gzip = False
+                    metrics.put_log_events_seconds.observe(time.monotonic() - start)
                 _log.debug("flush ok")
-                self.sequence_token = ret["nextSequenceToken"]
-                return
+                if self.sequence_tokens:
+                    self.sequence_token = ret["nextSequenceToken"]
+                metrics.batches_flushed.inc()
+                metrics.events_flushed.inc(len(batch.records))
+                metrics.bytes_flushed.inc(batch.nr_bytes)
+                if ret.get("rejectedLogEventsInfo"):
+                    _report_rejected(batch, ret["rejectedLogEventsInfo"])
+                return 0
             except self.client.exceptions.DataAlreadyAcceptedException:
                 _log.warning("DataAlreadyAcceptedException", exc_info=True)
-                return
+                return 0
             except self.client.exceptions.InvalidSequenceTokenException as e:
                 self.sequence_token = e.response["Error"]["Message"].split()[-1]
                 _log.info(
@@ -170,9 +638,198 @@ class LogWriter:
                         e.response["Error"]["Code"], self.sequence_token
                     )
                 )
+                metrics.sequence_token_resyncs.inc()
+                metrics.put_log_events_retries.inc(label_value=_error_name(e))
             except Exception as e:
-                _log.error("error: %r", e)
-                time.sleep(3)
+                if self.compress and _gzip_rejected(e):
+                    _log.warning(
+                        "gzip'd upload rejected, uploading uncompressed: %r", e
+                    )
+                    self.compress = False
+                    metrics.gzip_fallbacks.inc()
+                    continue
+                error_class = _classify_error(e)
+                policy = RETRY_POLICIES[error_class]
+                if policy is None:
+                    if error_class == "invalid" and len(batch.records) > 1:
+                        return self._flush_halves(batch, e)
+                    return self._drop(batch, error_class, e)
+                if failing_since is None:
+                    failing_since = time.monotonic()
+                elif (
+                    self.fallback
+                    and time.monotonic() - failing_since >= self.fallback_secs
+                    and self.fallback(batch.records)
+                ):
+                    _log.error(
+                        "gave up uploading %d events after %.0fs, kept locally",
+                        len(batch.records),
+                        time.monotonic() - failing_since,
+                    )
+                    metrics.events_fallen_back.inc(len(batch.records))
+                    return len(batch.records)
+                delay = _backoff(policy, nr_failures)
+                nr_failures += 1
+                _log.error(
+                    "%s error, retry %d in %.1fs: %r",
+                    error_class,
+                    nr_failures,
+                    delay,
+                    e,
+                )
+                metrics.put_log_events_retries.inc(label_value=_error_name(e))
+                time.sleep(delay)
+                if error_class == "missing":
+                    # the stream may have been deleted
+                    try:
+                        self._create_stream()
+                    except Exception as create_e:
+                        if _classify_error(create_e) == "missing":
+                            # so has the log group, which only an admin can
+                            # create again
+                            return self._drop(batch, "permanent", create_e)
+                        _log.error("error creating stream: %r", create_e)
+
+    def _flush_halves(self, batch, e):
+        """
+        Upload each half of @batch, which failed with "invalid" error @e, so
+        that only the events causing it are given up on
+        Returns: the number of events which weren't uploaded
+        """
+        _log.warning("splitting batch of %d events: %r", len(batch.records), e)
+        metrics.put_log_events_retries.inc(label_value=_error_name(e))
+        middle = len(batch.records) // 2
+        nr_failed = 0
+        for records in (batch.records[:middle], batch.records[middle:]):
+            half = _Batch()
+            half.records = records
+            half.nr_bytes = sum(r.size_in_bytes for r in records)
+            nr_failed += self._flush_events(half)
+        return nr_failed
+
+    def _drop(self, batch, error_class, e):
+        """
+        Give up on @batch for error @e, of @error_class, passing it to the
+        fallback if there is one
+        Returns: the number of events which weren't uploaded
+        """
+        _log.error(
+            "dropping %d events, %s error: %r", len(batch.records), error_class, e
+        )
+        metrics.events_rejected.inc(len(batch.records), label_value=_error_name(e))
+        if self.fallback:
+            self.fallback(batch.records)
+        return len(batch.records)
+
+
+def _classify_error(e):
+    """
+    Returns: the class of upload error @e, a key of RETRY_POLICIES
+    """
+    if isinstance(e, _CREDENTIAL_ERRORS):
+        return "auth"
+    if isinstance(e, _NETWORK_ERRORS):
+        return "transient"
+    if isinstance(e, botocore.exceptions.ParamValidationError):
+        return "permanent"
+    try:
+        status = e.response["ResponseMetadata"]["HTTPStatusCode"]
+        code = e.response["Error"]["Code"]
+    except (AttributeError, KeyError, TypeError):
+        # not an error from the service, which may be anything
+        return "transient"
+    if code in _THROTTLED_CODES or status == 429:
+        return "throttled"
+    if code == "ResourceNotFoundException":
+        return "missing"
+    if code in _PERMANENT_CODES:
+        return "permanent"
+    if code in _AUTH_CODES or status in (401, 403):
+        return "auth"
+    if 400 <= status < 500:
+        return "invalid"
+    return "transient"
+
+
+def rejects_destination(e):
+    """
+    Returns: whether error @e, from creating a LogWriter, means its log group
+    can't be written to, rather than that it can't be for now: it doesn't
+    exist, access to it is denied, or its name is invalid
+    """
+    return _classify_error(e) in ("missing", "invalid", "permanent")
+
+
+def _backoff(policy, nr_failures):
+    """
+    Returns: the seconds to wait after @nr_failures earlier failures, with
+    full jitter so that hosts throttled together don't retry together
+    """
+    first, cap = policy
+    return random.uniform(0, min(cap, first * 2 ** min(nr_failures, 32)))
+
+
+def _report_rejected(batch, info):
+    """
+    Log and count the events of @batch which PutLogEvents accepted but
+    discarded, as described by its rejectedLogEventsInfo @info
+    """
+    # the end indexes are exclusive, and expired events are also too old,
+    # so each event is counted once, for the first reason which applies
+    nr_records = len(batch.records)
+    expired_end = info.get("expiredLogEventEndIndex", 0)
+    too_old_end = max(info.get("tooOldLogEventEndIndex", 0), expired_end)
+    too_new_start = max(info.get("tooNewLogEventStartIndex", nr_records), too_old_end)
+    ranges = (
+        ("expired", 0, expired_end),
+        ("too_old", expired_end, too_old_end),
+        ("too_new", too_new_start, nr_records),
+    )
+    for reason, start, end in ranges:
+        rejected = batch.records[start:end]
+        if not rejected:
+            continue
+        _log.warning(
+            "%d events rejected as %s, timestamps %d..%d",
+            len(rejected),
+            reason.replace("_", " "),
+            rejected[0].timestamp,
+            rejected[-1].timestamp,
+        )
+        metrics.events_rejected.inc(len(rejected), label_value=reason)
+
+
+def _error_name(e):
+    """
+    Returns: the AWS error code of @e, if it has one, otherwise its type name
+    """
+    try:
+        return e.response["Error"]["Code"]
+    except (AttributeError, KeyError, TypeError):
+        return type(e).__name__
+
+
+def _gzip_rejected(e):
+    """
+    Returns: True if @e is the service refusing a gzip'd body
+    """
+    try:
+        status = e.response["ResponseMetadata"]["HTTPStatusCode"]
+        code = e.response["Error"]["Code"]
+    except (AttributeError, KeyError, TypeError):
+        return False
+    return status == 415 or code in _GZIP_REJECTED_CODES
+
+
+def _put_log_events_body(kwargs, records_json):
+    """
+    Returns: the PutLogEvents body for @kwargs, with @records_json in place
+    of kwargs["logEvents"]
+    """
+    head = {k: v for k, v in kwargs.items() if k != "logEvents"}
+    return json.dumps(head)[:-1].encode("utf-8") + b', "logEvents": %s}' % (
+        records_json
+    )
 
 
 def test():
@@ -3,37 +3,229 @@
 Upload messages to cloud watch logs
 """
 import errno
+import fnmatch
+import functools
 import json
 import logging
 import os
+import selectors
+import signal
 import socket
 import sys
 import threading
 import time
 import typing
+import urllib.parse
 
+import globus_cw_daemon.clients as clients
 import globus_cw_daemon.config as config
 import globus_cw_daemon.cwlogs as cwlogs
 import globus_cw_daemon.local_logging as local_logging
+import globus_cw_daemon.metrics as metrics
+import globus_cw_daemon.sinks as sinks
+import globus_cw_daemon.spool as spool
 
-# Note that the total memory limit is double this:
+# Note that the total event limit is double this:
 # * the flush thread can be flushing MAX_EVENT_QUEUE_LEN
 # * the front end thread can be receiving MAX_EVENT_QUEUE_LEN
+# Each destination has its own limit, which each client may fill its fair
+# share of (see clients.ClientQueues).
 MAX_EVENT_QUEUE_LEN = 100000
 
+# Memory use of each destination is bounded by this many event bytes,
+# counting both the queue and events being flushed, unless overridden by
+# max_queue_bytes in /etc/cwlogd.ini
+MAX_EVENT_QUEUE_BYTES = 128 * 1024 * 1024
+
+# Destinations other than the one in /etc/cwlogd.ini are created on demand,
+# up to this many destinations in all, unless overridden by max_destinations
+# in /etc/cwlogd.ini
+MAX_DESTINATIONS = 16
+
+# Destinations other than the default one which have had nothing to upload
+# for this long are removed, freeing their slot, unless overridden by
+# destination_idle_secs in /etc/cwlogd.ini
+DESTINATION_IDLE_SECS = 600
+
+# A destination whose log group can't be written to is removed, and requests
+# for it are refused for this long before it's tried again
+DESTINATION_REJECT_SECS = 300
+
+# The AWS limit on log group and stream name lengths
+MAX_DESTINATION_NAME_LEN = 512
+
 # The sucky thing about unix domain sockets.
 # When this is full, clients will go into a retry sleep loop
 SOCK_LISTEN_BACKLOG = 1024
 
-# How long to sleep between successful queue flushes
-FLUSH_WAIT_SECS = 1
+# Clients connect to the stream socket, or send unacknowledged requests,
+# one per datagram, to the datagram socket
+LISTEN_ADDR = "\0org.globus.cwlogs"
+DGRAM_ADDR = "\0org.globus.cwlogs.dgram"
+
+# systemd passes sockets from socket activation as these fds on, see
+# sd_listen_fds(3) and globus_cw_daemon.socket
+SD_LISTEN_FDS_START = 3
+
+# Largest datagram request accepted, and the receive buffer requested for
+# the datagram socket (the kernel may cap both lower)
+MAX_DGRAM_BYTES = 512 * 1024
+DGRAM_RCVBUF_BYTES = 4 * 1024 * 1024
+
+# How single event requests from globus_cw_client begin
+_EVENT_PREFIX = b'{"message": '
+
+# Size of each read from a client connection
+RECV_BUFSIZE = 64 * 1024
+
+# Close client connections which make no progress for this long,
+# unless overridden by read_timeout in /etc/cwlogd.ini
+READ_TIMEOUT_SECS = 30
+
+# Stop reading requests from a client with this many unsent response bytes
+MAX_CONN_WBUF_BYTES = 1024 * 1024
+
+# The queue is flushed as soon as it holds a full batch, or once its oldest
+# event has waited this long, unless overridden by flush_batch_bytes,
+# flush_batch_records, and flush_max_latency_ms in /etc/cwlogd.ini
+FLUSH_BATCH_BYTES = cwlogs.MAX_BATCH_BYTES
+FLUSH_BATCH_RECORDS = cwlogs.MAX_BATCH_RECORDS
+FLUSH_MAX_LATENCY_MS = 1000
+
+# Each flush takes at most this many batches' worth of bytes, round robin
+# from the clients' queues, so that a chatty client's backlog doesn't hold up
+# the events of others, and each submission to the upload pipeline is bounded
+FAIR_DRAIN_BATCHES = 8
+
+# On SIGTERM or SIGINT, queued events are uploaded for up to this many
+# seconds, unless overridden by shutdown_timeout in /etc/cwlogd.ini, and
+# whatever is left is spilled to disk. Keep it well within systemd's
+# TimeoutStopSec, since spilling takes time too.
+SHUTDOWN_TIMEOUT_SECS = 30
+
+# While shutting down, each destination uploads with at least this many
+# threads, unless uploads pass sequence tokens
+SHUTDOWN_UPLOAD_THREADS = 8
+
+# Where events left at shutdown are spilled, unless overridden by spill_dir
+# in /etc/cwlogd.ini; they're uploaded on the next start
+SPILL_DIR = "/var/lib/globus_cw_daemon/spill"
+
+# Spools (and spills) of destinations other than the default one are kept in
+# <spool_dir>/destinations/<group_name>/<stream_name>, with names %-quoted
+_DESTINATION_SPOOLS = "destinations"
 
 _log = logging.getLogger(__name__)
 
-# Data shared with flush thread
+
+class DaemonBusy(Exception):
+    """
+    Raised when an event can't be queued because the queue is full.
+    Clients are told to retry later.
+    """
+
+
+class RateLimited(DaemonBusy):
+    """
+    Raised when an event can't be queued because its client has sent more
+    than its rate limit allows.
+    """
+
+
+class Destination:
+    """
+    A log group and stream which events are uploaded to, with its own queue
+    and flush thread, so that a slow or throttled destination doesn't hold up
+    the others.
+    All attributes but writer are protected by _g_lock.
+    """
+
+    def __init__(self, group_name, stream_name, writer=None, spool=None):
+        """
+        @writer: the LogWriter for this destination, or None for the flush
+                 thread to create one
+        @spool: a Spool to queue events in, instead of memory
+        """
+        self.group_name = group_name
+        self.stream_name = stream_name
+        self.writer = writer
+        self.spool = spool
+        self.queue = clients.ClientQueues()
+        self.nr_dropped = 0
+        # Bytes of events in queue or being flushed from it
+        self.queue_bytes = 0
+        # Signalled when the queue holds a full batch
+        self.flush_cond = threading.Condition(_g_lock)
+        # Events and bytes queued since the last flush, and when the first of
+        # them (or the first drop) happened, by time.monotonic()
+        self.nr_pending = 0
+        self.nr_pending_bytes = 0
+        self.pending_since: typing.Optional[float] = None
+        # spool segments submitted for upload, not yet removed
+        self.uploading_segments: typing.Set[typing.Any] = set()
+        # events submitted for upload and not yet uploaded, by id of their
+        # list, to be spilled if still there at shutdown
+        self.uploading_events: typing.Dict[int, typing.List[cwlogs.Event]] = {}
+        # events spilled at the last shutdown, if any, being replayed
+        self.spill: typing.Optional[spool.Spool] = None
+        # when events were last queued, by time.monotonic()
+        self.last_active = time.monotonic()
+        # why the log group can't be written to, once found; requests for the
+        # destination are refused from then on
+        self.rejected: typing.Optional[str] = None
+        # set once the destination is removed, for its flush thread to stop
+        self.closed = False
+
+
+# Data shared with flush threads
 _g_lock = threading.Lock()
-_g_queue: typing.List[cwlogs.Event] = []  # List of Events
-_g_nr_dropped = 0
+# The destination from /etc/cwlogd.ini, and every destination, by
+# (group_name, stream_name)
+_g_default: typing.Optional[Destination] = None
+_g_destinations: typing.Dict[typing.Tuple[str, str], Destination] = {}
+_g_max_destinations = MAX_DESTINATIONS
+_g_destination_idle_secs = DESTINATION_IDLE_SECS
+# fnmatch patterns of the log groups which requests may name, other than the
+# default one, and of the streams they may name in the default log group,
+# other than the default one, from config; by default, none
+_g_allowed_groups: typing.List[str] = []
+_g_allowed_streams: typing.List[str] = []
+# (group_name, stream_name) -> (time.monotonic() until which requests are
+# refused, why) for recently rejected destinations; only the request loop
+# uses this
+_g_rejected_destinations: typing.Dict[
+    typing.Tuple[str, str], typing.Tuple[float, str]
+] = {}
+# Byte budget for each destination's queue, from config
+_g_max_queue_bytes = MAX_EVENT_QUEUE_BYTES
+# Flush thresholds, from config
+_g_flush_batch_bytes = FLUSH_BATCH_BYTES
+_g_flush_batch_records = FLUSH_BATCH_RECORDS
+_g_flush_max_latency = FLUSH_MAX_LATENCY_MS / 1000
+# LogWriter keyword arguments and spool settings for new destinations, from
+# config; when spool_dir is set, events are queued on disk instead of memory
+_g_writer_kwargs: typing.Dict[str, typing.Any] = {}
+_g_spool_dir: typing.Optional[str] = None
+_g_spool_max_bytes = spool.MAX_SPOOL_BYTES
+# Set when a spool has enough unsynced bytes to fsync them early
+_g_sync_wakeup = threading.Event()
+# What identifies clients, and their rate limits if any, from config; only
+# the request loop uses these
+_g_client_key = clients.CLIENT_KEY
+_g_rate_limiter: typing.Optional[clients.RateLimiter] = None
+# Local sinks, and whether all events or only failing uploads go to them,
+# from config
+_g_sinks: typing.List[typing.Any] = []
+_g_sink_mode = sinks.SINK_MODE
+# Where to spill events at shutdown, from config
+_g_spill_dir = SPILL_DIR
+# Set at shutdown: flush threads flush whatever is queued, without waiting
+# for a full batch
+_g_stopping = False
+# SIGTERMs and SIGINTs received; set by the signal handler alone
+_g_nr_stop_signals = 0
+# The socket pair which signals wake the request loop through
+_g_wakeup_socks: typing.List[socket.socket] = []
 
 # get constant instance_id on start
 try:
@@ -49,52 +241,306 @@ def _print(m):
     sys.stdout.flush()
 
 
-def flush_thread_main(writer):
+def flush_thread_main(dest):
     try:
-        _flush_thread_main(writer)
+        _flush_thread_main(dest)
     except Exception as e:
         _log.exception(e)
         sys.exit(1)
 
 
-def _flush_thread_main(writer):
-    global _g_queue
-    global _g_nr_dropped
-    _log.info("flush_thread_main started")
+def _flush_thread_main(dest):
+    _log.info("flush_thread_main started, %s %s", dest.group_name, dest.stream_name)
+    if dest.writer is None:
+        dest.writer = _make_writer(dest)
+        if dest.writer is None:
+            return
+    if dest.spill is not None:
+        _replay_spill(dest)
 
-    heartbeats = config.get_bool("heartbeats")
+    # heartbeats only go to the default destination
+    heartbeats = dest is _g_default and config.get_bool("heartbeats")
     hb_interval = config.get_int("heartbeat_interval")
-    time_since_hb = 0
-
-    while True:
-        time.sleep(FLUSH_WAIT_SECS)
-        if heartbeats:
-            time_since_hb += FLUSH_WAIT_SECS
-        _log.debug("checking queue")
+    next_hb = time.monotonic() + hb_interval if heartbeats else None
 
+    while not dest.closed:
+        segments = []
+        taken = {}
         with _g_lock:
-            new_data = _g_queue
-            nr_found = len(new_data)
-            nr_dropped = _g_nr_dropped
-            _g_queue = []
-            _g_nr_dropped = 0
+            _wait_for_flush(dest, next_hb)
+            if dest.closed:
+                # removed for being idle, so there's nothing left to upload
+                break
+            _log.debug("checking queue")
+
+            pending_since = dest.pending_since
+            if pending_since is not None:
+                metrics.flush_lag_seconds.observe(time.monotonic() - pending_since)
+            dest.nr_pending = 0
+            dest.nr_pending_bytes = 0
+            dest.pending_since = None
+            if dest.spool is not None:
+                dest.spool.seal()
+                segments = [
+                    segment
+                    for segment in dest.spool.sealed_segments()
+                    if segment not in dest.uploading_segments
+                ]
+                dest.uploading_segments.update(segments)
+                new_data = []
+                nr_found = dest.spool.nr_events
+            else:
+                new_data, taken = dest.queue.drain(
+                    _g_flush_batch_bytes * FAIR_DRAIN_BATCHES
+                )
+                nr_found = len(new_data)
+                if new_data:
+                    # spilled from here on, should the daemon stop
+                    dest.uploading_events[id(new_data)] = new_data
+                if dest.queue:
+                    # the rest has waited as long, so is flushed right after
+                    dest.nr_pending = len(dest.queue)
+                    dest.nr_pending_bytes = dest.queue.nr_bytes
+                    dest.pending_since = pending_since or time.monotonic()
+            nr_dropped = dest.nr_dropped
+            dest.nr_dropped = 0
 
         _log.debug("found %d events", nr_found)
+        nr_found_bytes = sum(e.size_in_bytes for e in new_data)
 
         # if heartbeats are on and heartbeat_interval seconds have passed
         # then send a heartbeat to cw logs
-        if heartbeats and time_since_hb >= hb_interval:
+        if next_hb is not None and time.monotonic() >= next_hb:
             _log.info("sending heartbeat event")
-            hb_event = _get_heartbeat_event(nr_found)
+            hb_event = _get_heartbeat_event(dest, nr_found)
             new_data.append(hb_event)
-            time_since_hb = 0
+            next_hb = time.monotonic() + hb_interval
 
         if nr_dropped:
             _log.warn("dropped %d events", nr_dropped)
             event = _get_drop_event(nr_dropped)
             new_data.append(event)
 
-        writer.upload_events(new_data)
+        # hand the events to the writer's upload pipeline, which batches them
+        # and uploads the batches while this thread drains the next events;
+        # when the pipeline is full, this waits for it.
+        # spooled events are only removed from disk once they're uploaded,
+        # and read one segment at a time to bound memory use
+        tee = _g_sinks and _g_sink_mode == "tee"
+        for segment in segments:
+            events = spool.read_segment(segment)
+            if tee:
+                _write_sinks(dest.group_name, dest.stream_name, events)
+            dest.writer.submit(
+                events,
+                on_done=functools.partial(_segment_uploaded, dest, segment),
+            )
+        if new_data and tee:
+            _write_sinks(dest.group_name, dest.stream_name, new_data)
+        if new_data:
+            with _g_lock:
+                # again, in case it only now holds a heartbeat or drop event
+                dest.uploading_events[id(new_data)] = new_data
+            dest.writer.submit(
+                new_data,
+                on_done=functools.partial(
+                    _events_uploaded, dest, new_data, nr_found_bytes, taken
+                ),
+            )
+    _log.info("flush_thread_main stopped, %s %s", dest.group_name, dest.stream_name)
+    dest.writer.close()
+
+
+def syncer_thread_main():
+    """
+    fsync the spools' writes in batches, every spool.FSYNC_INTERVAL_SECS or
+    sooner once one has spool.FSYNC_BYTES unsynced, outside of _g_lock, so
+    that the request loop never waits on the disk. Clients are acked once
+    their events are written to the OS, before they're fsync'd.
+    """
+    while True:
+        _g_sync_wakeup.wait(spool.FSYNC_INTERVAL_SECS)
+        _g_sync_wakeup.clear()
+        fds = []
+        with _g_lock:
+            for dest in _g_destinations.values():
+                if dest.spool is not None:
+                    fds.extend(dest.spool.take_unsynced())
+        spool.sync_fds(fds)
+
+
+def _write_sinks(group_name, stream_name, events):
+    """
+    Write @events for the destination @group_name, @stream_name to every
+    local sink; a sink which fails is logged, and doesn't stop the others
+    Returns: True if any sink took the events
+    """
+    written = False
+    for sink in _g_sinks:
+        try:
+            sink.write(group_name, stream_name, events)
+        except Exception as e:
+            _log.error(
+                "error writing %d events to %s sink: %r", len(events), sink.name, e
+            )
+            metrics.sink_errors.inc(label_value=sink.name)
+            continue
+        metrics.sink_events.inc(len(events), label_value=sink.name)
+        written = True
+    return written
+
+
+def _replay_spill(dest):
+    """
+    Submit the events @dest spilled at the last shutdown for upload, one
+    segment at a time; each segment is removed once uploaded
+    """
+    with _g_lock:
+        segments = dest.spill.sealed_segments()
+    for segment in segments:
+        dest.writer.submit(
+            spool.read_segment(segment),
+            on_done=functools.partial(_spill_uploaded, dest, segment),
+        )
+
+
+def _segment_uploaded(dest, segment):
+    with _g_lock:
+        dest.spool.remove(segment)
+        dest.uploading_segments.discard(segment)
+
+
+def _spill_uploaded(dest, segment):
+    with _g_lock:
+        dest.spill.remove(segment)
+
+
+def _events_uploaded(dest, events, nr_bytes, taken):
+    with _g_lock:
+        # unless already spilled at shutdown
+        dest.uploading_events.pop(id(events), None)
+        dest.queue_bytes -= nr_bytes
+        dest.queue.release(taken)
+
+
+def _make_writer(dest):
+    """
+    Create the LogWriter for @dest, retrying until it succeeds; meanwhile,
+    events for @dest are queued as usual
+    Returns: the LogWriter, or None if @dest was rejected for its log group
+             not being writable, or removed
+    """
+    delay = 1
+    while not dest.closed:
+        try:
+            return cwlogs.LogWriter(
+                dest.group_name, dest.stream_name, **_g_writer_kwargs
+            )
+        except Exception as e:
+            if cwlogs.rejects_destination(e):
+                _reject_destination(dest, e)
+                return None
+            _log.error(
+                "error creating writer for %s %s: %r",
+                dest.group_name,
+                dest.stream_name,
+                e,
+            )
+            time.sleep(delay)
+            delay = min(delay * 2, 60)
+    return None
+
+
+def _reject_destination(dest, e):
+    """
+    Refuse requests for @dest, whose log group can't be written to for error
+    @e, from now on, and hand the events it holds, queued or on disk, to the
+    local sinks, or else drop them. The request loop then removes it.
+    """
+    _log.error("rejecting destination %s %s: %r", dest.group_name, dest.stream_name, e)
+    stores = []
+    with _g_lock:
+        dest.rejected = str(e)
+        events, _ = dest.queue.drain()
+        dest.queue_bytes = 0
+        dest.nr_dropped = 0
+        dest.nr_pending = 0
+        dest.nr_pending_bytes = 0
+        dest.pending_since = None
+        for store in (dest.spool, dest.spill):
+            if store is not None:
+                store.seal()
+                stores.append(store)
+    _discard_events(dest, events)
+    # one segment at a time, to bound memory use
+    for store in stores:
+        for segment in store.sealed_segments():
+            _discard_events(dest, spool.read_segment(segment))
+            with _g_lock:
+                store.remove(segment)
+
+
+def _discard_events(dest, events):
+    """
+    Write @events of rejected @dest to the local sinks, or else drop them
+    """
+    if not events:
+        return
+    metrics.events_rejected.inc(len(events), label_value="destination_rejected")
+    if _write_sinks(dest.group_name, dest.stream_name, events):
+        return
+    _log.error(
+        "dropping %d events for %s %s", len(events), dest.group_name, dest.stream_name
+    )
+
+
+def _wait_for_flush(dest, next_hb):
+    """
+    Wait until the queue of @dest holds a full batch, the oldest queued event
+    (or drop) has waited the max flush latency, or the @next_hb time is
+    reached, whichever comes first; while shutting down, don't wait for
+    queued events at all
+    Must be called with _g_lock held
+    """
+    while not _batch_is_full(dest):
+        if dest.closed:
+            return
+        if _g_stopping and dest.pending_since is not None:
+            return
+        deadline = next_hb
+        if dest.pending_since is not None:
+            flush_at = dest.pending_since + _g_flush_max_latency
+            deadline = flush_at if deadline is None else min(deadline, flush_at)
+
+        if deadline is None:
+            dest.flush_cond.wait()
+            continue
+        timeout = deadline - time.monotonic()
+        if timeout <= 0:
+            return
+        dest.flush_cond.wait(timeout)
+
+
+def _mark_pending(dest, nr_events, nr_bytes):
+    """
+    Record @nr_events totalling @nr_bytes as queued for @dest, and wake its
+    flush thread if they fill a batch, or start its max latency countdown
+    Must be called with _g_lock held
+    """
+    dest.nr_pending += nr_events
+    dest.nr_pending_bytes += nr_bytes
+    if dest.pending_since is None:
+        dest.pending_since = time.monotonic()
+        dest.flush_cond.notify()
+    elif _batch_is_full(dest):
+        dest.flush_cond.notify()
+
+
+def _batch_is_full(dest):
+    return (
+        dest.nr_pending_bytes >= _g_flush_batch_bytes
+        or dest.nr_pending >= _g_flush_batch_records
+    )
 
 
 def _get_drop_event(nr_dropped):
@@ -108,98 +554,845 @@ def _get_drop_event(nr_dropped):
     return ret
 
 
-def _health_info(q_len=None):
+def _health_info(dest, q_len=None):
     """
-    compute daemon health info
-    based only on the visible state of the frontend queue
+    compute daemon health info for destination @dest
+    based only on the visible state of its frontend queue
 
     the queue length can be passed by the caller (for visibility during flush)
-    or it will be taken from len(_g_queue)
+    or it will be taken from len(dest.queue)
     """
+    if dest.spool is not None:
+        if q_len is None:
+            q_len = dest.spool.nr_events  # no lock, but safe
+        q_pct = (dest.spool.nr_bytes / float(dest.spool.max_bytes)) * 100
+        return dict(queue_length=q_len, queue_percent_full=q_pct)
+
     if q_len is None:
-        q_len = len(_g_queue)  # no lock, but safe
+        q_len = len(dest.queue)  # no lock, but safe
     q_pct = (q_len / float(MAX_EVENT_QUEUE_LEN)) * 100
+    q_pct = max(q_pct, (dest.queue_bytes / float(_g_max_queue_bytes)) * 100)
     return dict(queue_length=q_len, queue_percent_full=q_pct)
 
 
-def _get_heartbeat_event(nr_found):
+def _pending_age(dest):
+    """
+    Returns: how long the oldest event (or drop) for @dest not yet picked up
+    by its flush thread has waited, in seconds
+    """
+    pending_since = dest.pending_since  # no lock, but safe
+    if pending_since is None:
+        return 0.0
+    return time.monotonic() - pending_since
+
+
+def _queue_bytes(dest):
+    if dest.spool is not None:
+        return dest.spool.nr_bytes  # no lock, but safe
+    return dest.queue_bytes
+
+
+def _all_destinations():
+    return list(_g_destinations.values())  # no lock, but safe
+
+
+metrics.Gauge(
+    "cwlogs_destinations",
+    "Log group and stream pairs being uploaded to",
+    lambda: len(_g_destinations),
+)
+metrics.Gauge(
+    "cwlogs_queue_events",
+    "Events queued awaiting upload, in memory or spooled, for all destinations",
+    lambda: sum(_health_info(d)["queue_length"] for d in _all_destinations()),
+)
+metrics.Gauge(
+    "cwlogs_queue_bytes",
+    "Bytes of events queued or being uploaded, in memory or spooled, for all "
+    "destinations",
+    lambda: sum(_queue_bytes(d) for d in _all_destinations()),
+)
+metrics.Gauge(
+    "cwlogs_queue_percent_full",
+    "How full the fullest destination's queue is, as reported to clients",
+    lambda: max(
+        (_health_info(d)["queue_percent_full"] for d in _all_destinations()),
+        default=0.0,
+    ),
+)
+metrics.Gauge(
+    "cwlogs_pipeline_submissions_waiting",
+    "Drained events waiting to be batched, in submissions from flush threads, "
+    "for all destinations",
+    lambda: sum(
+        d.writer.nr_submissions_waiting for d in _all_destinations() if d.writer
+    ),
+)
+metrics.Gauge(
+    "cwlogs_pipeline_batches_waiting",
+    "Serialized batches waiting for an upload thread, for all destinations",
+    lambda: sum(d.writer.nr_batches_waiting for d in _all_destinations() if d.writer),
+)
+metrics.Gauge(
+    "cwlogs_queue_oldest_age_seconds",
+    "How long the oldest event not yet picked up for upload has waited",
+    lambda: max((_pending_age(d) for d in _all_destinations()), default=0.0),
+)
+
+
+def _get_heartbeat_event(dest, nr_found):
     data = dict(
         type="audit",
         subtype="cwlogs.heartbeat",
         instance_id=INSTANCE_ID,
-        health=_health_info(nr_found),
+        health=_health_info(dest, nr_found),
     )
     ret = cwlogs.Event(timestamp=None, message=json.dumps(data))
     return ret
 
 
-def do_request(sock):
+def _get_destination(spec):
     """
-    @sock: a client socket connection
-    Post: response is sent but @sock is left open
+    @spec: a request's destination, {"group_name": ..., "stream_name": ...}
+           with either name defaulting to the one in /etc/cwlogd.ini,
+           or None for the default destination
+    Returns: the Destination, which is created if new
+    Raise: exception if @spec is invalid, names a log group which isn't
+           allowed or was rejected lately, or there are too many destinations
     """
-    # Read <json_data>\n
-    buf = b""
-    while True:
-        chunk = sock.recv(4000)
+    if spec is None:
+        return _g_default
+    if not isinstance(spec, dict) or not spec.keys() <= {"group_name", "stream_name"}:
+        raise ValueError("destination must have only group_name and stream_name")
+    group_name = spec.get("group_name", _g_default.group_name)
+    stream_name = spec.get("stream_name", _g_default.stream_name)
+    for name in (group_name, stream_name):
+        if not isinstance(name, str) or not 0 < len(name) <= MAX_DESTINATION_NAME_LEN:
+            raise ValueError("invalid destination name")
+
+    dest = _g_destinations.get((group_name, stream_name))  # no lock, but safe
+    if dest is None:
+        _check_destination(group_name, stream_name)
+        dest = _add_destination(group_name, stream_name)
+    return dest
+
+
+def _check_destination(group_name, stream_name):
+    """
+    Raise: exception if @group_name, or @stream_name in the default log group,
+           isn't allowed, or the destination was rejected within
+           DESTINATION_REJECT_SECS
+    """
+    if group_name != _g_default.group_name:
+        if not _matches_any(group_name, _g_allowed_groups):
+            raise ValueError(f"log group {group_name} is not allowed")
+    elif stream_name != _g_default.stream_name:
+        if not _matches_any(stream_name, _g_allowed_streams):
+            raise ValueError(f"log stream {stream_name} is not allowed")
+    rejected = _g_rejected_destinations.get((group_name, stream_name))
+    if rejected is not None and time.monotonic() < rejected[0]:
+        raise Exception(f"destination rejected: {rejected[1]}")
+
+
+def _matches_any(name, patterns):
+    return any(fnmatch.fnmatchcase(name, p) for p in patterns)
+
+
+def _parse_patterns(value):
+    """
+    Returns: the list of fnmatch patterns in comma-separated @value
+    """
+    return [pattern.strip() for pattern in value.split(",") if pattern.strip()]
+
+
+def _reclaim_destinations(now):
+    """
+    Remove the destinations which were rejected, or have had nothing to
+    upload for destination_idle_secs, freeing their slots; their flush
+    threads stop. Only called from the request loop, so that no request is
+    between finding a destination and queueing events for it.
+    """
+    with _g_lock:
+        for key, dest in list(_g_destinations.items()):
+            if dest is _g_default:
+                continue
+            if dest.rejected is not None:
+                reason = "rejected"
+                _g_rejected_destinations[key] = (
+                    now + DESTINATION_REJECT_SECS,
+                    dest.rejected,
+                )
+            elif _is_idle(dest) and now - dest.last_active >= _g_destination_idle_secs:
+                reason = "idle"
+            else:
+                continue
+            del _g_destinations[key]
+            dest.closed = True
+            dest.flush_cond.notify()
+            for store in (dest.spool, dest.spill):
+                if store is not None:
+                    store.close()
+            _log.info("removed %s destination %s %s", reason, *key)
+            metrics.destinations_removed.inc(label_value=reason)
+        for key, (until, _) in list(_g_rejected_destinations.items()):
+            if until <= now:
+                del _g_rejected_destinations[key]
+
+
+def _is_idle(dest):
+    """
+    Returns: whether @dest has nothing queued, spooled or being uploaded
+    Must be called with _g_lock held
+    """
+    return (
+        not dest.queue
+        and not dest.nr_dropped
+        and dest.pending_since is None
+        and not dest.uploading_events
+        and not dest.uploading_segments
+        and (dest.spool is None or not dest.spool.nr_events)
+        and (dest.spill is None or not dest.spill.sealed_segments())
+    )
+
+
+def _add_destination(
+    group_name, stream_name, writer=None, dest_spool=None, default=False
+):
+    """
+    Create a Destination and start its flush thread.
+    Unless @dest_spool is given, the destination gets its own spool if
+    spool_dir is configured.
+    If @default, it becomes the default destination.
+    Raise: exception if there are too many destinations
+    """
+    global _g_default
+    with _g_lock:
+        dest = _g_destinations.get((group_name, stream_name))
+        if dest is not None:
+            return dest
+        if len(_g_destinations) >= _g_max_destinations:
+            raise Exception("too many destinations")
+
+        if dest_spool is None and _g_spool_dir:
+            dest_spool = spool.Spool(
+                _destination_path(_g_spool_dir, group_name, stream_name),
+                max_bytes=_g_spool_max_bytes,
+            )
+        dest = Destination(group_name, stream_name, writer=writer, spool=dest_spool)
+        if dest_spool is not None and dest_spool.nr_events:
+            # replay events left over from the last run right away
+            _mark_pending(dest, dest_spool.nr_events, dest_spool.nr_bytes)
+        spill_path = _spill_path(dest, default)
+        if os.path.isdir(spill_path):
+            dest.spill = spool.Spool(spill_path)
+        _g_destinations[(group_name, stream_name)] = dest
+        if default:
+            _g_default = dest
+
+    _log.info("added destination %s %s", group_name, stream_name)
+    flush_thread = threading.Thread(target=flush_thread_main, args=(dest,))
+    flush_thread.daemon = True
+    flush_thread.start()
+    return dest
+
+
+def _destination_path(root, group_name, stream_name):
+    return os.path.join(
+        root,
+        _DESTINATION_SPOOLS,
+        urllib.parse.quote(group_name, safe=""),
+        urllib.parse.quote(stream_name, safe=""),
+    )
+
+
+def _spill_path(dest, default=False):
+    if default:
+        return _g_spill_dir
+    return _destination_path(_g_spill_dir, dest.group_name, dest.stream_name)
+
+
+def _stored_destinations(root):
+    """
+    Returns: the (group_name, stream_name) of every destination other than
+    the default one with events left over from the last run in the spool or
+    spill directory @root
+    """
+    found = []
+    root = os.path.join(root, _DESTINATION_SPOOLS)
+    if not os.path.isdir(root):
+        return found
+    for group_dir in sorted(os.listdir(root)):
+        for stream_dir in sorted(os.listdir(os.path.join(root, group_dir))):
+            path = os.path.join(root, group_dir, stream_dir)
+            if any(name.endswith(".seg") for name in os.listdir(path)):
+                found.append(
+                    (urllib.parse.unquote(group_dir), urllib.parse.unquote(stream_dir))
+                )
+    return found
+
+
+class ClientConnection:
+    """
+    The state of one client connection served by the request loop.
+    Requests are newline-delimited, and clients may pipeline them;
+    responses are sent in request order.
+    """
+
+    def __init__(self, sock, client=None):
+        """
+        @client: what identifies the client, for rate limits and fair queuing
+        """
+        self.sock = sock
+        self.client = client
+        self.rbuf = b""
+        self.wbuf = b""
+        self.last_active = time.monotonic()
+
+    def on_readable(self):
+        """
+        Read from the client and handle every complete request received.
+        Returns: False if the client closed the connection, otherwise True
+        """
+        chunk = self.sock.recv(RECV_BUFSIZE)
         if not chunk:
-            raise Exception("no data")
-        buf += chunk
-        if buf.endswith(b"\n"):
-            break
+            if self.rbuf:
+                raise Exception("no data")
+            return False
+        self.last_active = time.monotonic()
+        self.rbuf += chunk
+        if b"\n" in chunk:
+            # Read <json_data>\n for every complete request received so far
+            *requests, self.rbuf = self.rbuf.split(b"\n")
+            self.wbuf += b"".join(do_request(data, self.client) for data in requests)
+            self.on_writable()
+        return True
+
+    def on_writable(self):
+        """
+        Send as much of the pending responses as the socket accepts.
+        """
+        if self.wbuf:
+            try:
+                nr_sent = self.sock.send(self.wbuf)
+            except BlockingIOError:
+                return
+            self.wbuf = self.wbuf[nr_sent:]
+            self.last_active = time.monotonic()
 
-    d = json.loads(buf[:-1].decode("utf-8"))
-    _log.debug("request: %r", d)
+    @property
+    def selector_events(self):
+        # stop reading requests from a client which isn't reading responses
+        if len(self.wbuf) > MAX_CONN_WBUF_BYTES:
+            return selectors.EVENT_WRITE
+        if self.wbuf:
+            return selectors.EVENT_READ | selectors.EVENT_WRITE
+        return selectors.EVENT_READ
 
+
+def do_request(data, client=None):
+    """
+    @data: a single request, without the trailing newline
+    @client: what identifies the client which sent it
+    Returns: the encoded response, including the trailing newline
+    """
     try:
-        _handle_request(d)
-        response = dict(status="ok", health=_health_info())
+        d, json_message = _parse_request(data)
+        _log.debug("request: %r", d)
+        dest = _get_destination(d.get("destination"))
+        results = _handle_request(dest, d, json_message=json_message, client=client)
+        response = dict(status="ok", health=_health_info(dest))
+        if results is not None:
+            response["results"] = results
+    except DaemonBusy as e:
+        _log.warning("busy %r", e)
+        response = dict(status="busy", message=repr(e), health=_health_info(dest))
     except Exception as e:
         _log.exception("error %r", e)
         response = dict(status="error", message=repr(e))
 
     _log.debug("response: %r", response)
-    buf = json.dumps(response, indent=None).encode("utf-8") + b"\n"
-    sock.sendall(buf)
+    return json.dumps(response, indent=None).encode("utf-8") + b"\n"
+
+
+def do_datagram(data, client=None):
+    """
+    @data: a single unacknowledged request
+    @client: what identifies the client which sent it
+    Errors can't be reported to the client, so every event lost is counted
+    as dropped instead.
+    """
+    try:
+        d, json_message = _parse_request(data)
+        dest = _get_destination(d.get("destination"))
+    except Exception as e:
+        _log.error("bad datagram request: %r", e)
+        _count_dropped(_g_default, 1)
+        return
+    _log.debug("datagram request: %r", d)
+
+    try:
+        _handle_request(dest, d, ack=False, json_message=json_message, client=client)
+    except Exception as e:
+        _log.error("error %r", e)
+
 
+def _parse_request(data):
+    """
+    @data: a single request, as utf8 JSON
+    Returns: the decoded request, and for a single event request as sent by
+             globus_cw_client, the JSON of its message, otherwise None
+    """
+    d = json.loads(data, object_pairs_hook=_unique_keys_dict)
+    if not isinstance(d, dict) or not data.startswith(_EVENT_PREFIX):
+        return d, None
+
+    # the request is exactly {"message": <json_message>, "timestamp": <int>},
+    # optionally followed by "destination", so the message's JSON can be
+    # sliced out without encoding it again
+    timestamp = d.get("timestamp")
+    if type(timestamp) is not int or not isinstance(d.get("message"), str):
+        return d, None
+    if len(d) == 2:
+        suffix = b', "timestamp": %d}' % timestamp
+    elif len(d) == 3 and "destination" in d:
+        suffix = b', "timestamp": %d, "destination": %s}' % (
+            timestamp,
+            json.dumps(d["destination"]).encode("utf-8"),
+        )
+    else:
+        return d, None
+    if not data.endswith(suffix):
+        return d, None
+    return d, data[len(_EVENT_PREFIX) : -len(suffix)]
+
+
+def _unique_keys_dict(pairs):
+    # a duplicate key would make the slicing in _parse_request unsound
+    d = dict(pairs)
+    if len(d) != len(pairs):
+        raise ValueError("duplicate keys in request")
+    return d
 
-def _handle_request(d):
-    event = cwlogs.Event(timestamp=d["timestamp"], message=d["message"])
+
+def _count_dropped(dest, nr_dropped):
+    with _g_lock:
+        dest.nr_dropped += nr_dropped
+        _mark_pending(dest, 0, 0)
+    metrics.events_dropped.inc(nr_dropped)
+
+
+def _count_refused(dest, nr_refused, ack):
+    """
+    Count @nr_refused events given a busy status: as refused if the client
+    was told (@ack), which it retries, otherwise as dropped
+    """
+    if ack:
+        metrics.events_refused.inc(nr_refused)
+    else:
+        _count_dropped(dest, nr_refused)
+
+
+def _handle_request(dest, d, ack=True, json_message=None, client=None):
+    """
+    Queue the event(s) of request @d from @client for destination @dest
+    If the request is not acknowledged (@ack is False), invalid events are
+    also counted as dropped.
+    @json_message: the JSON of a single event's message, if known
+    Returns: per-message results for a batch request, otherwise None
+    Raise: exception if a single event is invalid or can't be queued
+    """
+    if "messages" in d:
+        return _handle_batch_request(dest, d["messages"], ack=ack, client=client)
+
+    try:
+        event = cwlogs.Event(
+            timestamp=d["timestamp"], message=d["message"], json_message=json_message
+        )
+    except Exception:
+        if not ack:
+            _count_dropped(dest, 1)
+        raise
 
     # do a local log if on debug level logging
-    _log.debug("%s %s", event.timestamp, event.unicode_message)
+    if _log.isEnabledFor(logging.DEBUG):
+        _log.debug("%s %s", event.timestamp, event.unicode_message)
+
+    if not _take_tokens(client, 1):
+        # refused, as for a full queue below
+        _count_refused(dest, 1, ack)
+        metrics.events_rate_limited.inc()
+        raise RateLimited("client rate limit exceeded")
 
     with _g_lock:
-        if len(_g_queue) < MAX_EVENT_QUEUE_LEN:
-            _g_queue.append(event)
+        queued = _queue_events(dest, [event], client)
+    if not queued:
+        # For HIPAA, we prefer not to drop the record silently.
+        # Send a busy status to the client, which can sleep and retry a
+        # few times.  An unacknowledged event is lost, so it's counted as
+        # dropped.
+        _count_refused(dest, 1, ack)
+        raise DaemonBusy("too many events in queue")
+
+
+def _handle_batch_request(dest, messages, ack=True, client=None):
+    """
+    Queue every valid event in @messages from @client for @dest, as far as
+    the client's rate limit allows, taking the lock only once
+    Returns: a list with a status dict for each message, in order
+    """
+    results: typing.List[typing.Optional[dict]] = []
+    events = []
+    for m in messages:
+        try:
+            event = cwlogs.Event(timestamp=m["timestamp"], message=m["message"])
+        except Exception as e:
+            _log.debug("rejected batch message: %r", e)
+            results.append(dict(status="error", message=repr(e)))
         else:
-            # For HIPAA, we prefer not to drop the record silently.
-            # Send an error to the client.  We also record the drop count.
-            # TODO: We could make this a special error code and clients
-            # could sleep and retry a few times.  But we don't want to put a
-            # sleep in this receiving thread, since that would stall other
-            # requests indefinitely.
-            global _g_nr_dropped
-            _g_nr_dropped += 1
-            raise Exception("too many events in queue")
-
-
-def run_request_loop(listen_sock):
-    while True:
+            _log.debug("%s %s", event.timestamp, event.unicode_message)
+            events.append(event)
+            results.append(None)
+
+    nr_allowed = _take_tokens(client, len(events))
+    if nr_allowed < len(events):
+        metrics.events_rate_limited.inc(len(events) - nr_allowed)
+    with _g_lock:
+        nr_accepted = _queue_events(dest, events[:nr_allowed], client)
+    # as for single events, refusals are reported to the client, and counted
+    # as drops if it can't be told
+    if nr_accepted < len(events):
+        _count_refused(dest, len(events) - nr_accepted, ack)
+    if not ack and len(results) > len(events):
+        _count_dropped(dest, len(results) - len(events))
+
+    ok = dict(status="ok")
+    full = dict(status="busy", message=repr(DaemonBusy("too many events in queue")))
+    limited = dict(
+        status="busy", message=repr(RateLimited("client rate limit exceeded"))
+    )
+    nr_seen = 0
+    for i, result in enumerate(results):
+        if result is None:
+            if nr_seen < nr_accepted:
+                results[i] = ok
+            elif nr_seen < nr_allowed:
+                results[i] = full
+            else:
+                results[i] = limited
+            nr_seen += 1
+    return results
+
+
+def _take_tokens(client, nr_events):
+    """
+    Returns: how many of @nr_events from @client its rate limit allows
+    """
+    if _g_rate_limiter is None:
+        return nr_events
+    return _g_rate_limiter.take(client, nr_events)
+
+
+def _queue_events(dest, events, client=None):
+    """
+    Queue as many of @events from @client for @dest as there is room for, in
+    order; in memory, that's at most the client's fair share of the queue
+    Must be called with _g_lock held
+    Returns: the number of events queued
+    Raise: exception if @dest was rejected
+    """
+    if dest.rejected is not None:
+        raise Exception(f"destination rejected: {dest.rejected}")
+    dest.last_active = time.monotonic()
+    if dest.spool is not None:
+        nr_queued = dest.spool.append(events)
+        nr_bytes = sum(e.size_in_bytes for e in events[:nr_queued])
+        if dest.spool.nr_unsynced >= spool.FSYNC_BYTES:
+            _g_sync_wakeup.set()
+    else:
+        nr_queued = 0
+        nr_bytes = 0
+        nr_share, nr_share_bytes = dest.queue.share(
+            client, MAX_EVENT_QUEUE_LEN, _g_max_queue_bytes
+        )
+        nr_free = min(len(events), MAX_EVENT_QUEUE_LEN - len(dest.queue), nr_share)
+        nr_free_bytes = min(_g_max_queue_bytes - dest.queue_bytes, nr_share_bytes)
+        for event in events[:nr_free]:
+            if nr_bytes + event.size_in_bytes > nr_free_bytes:
+                break
+            nr_queued += 1
+            nr_bytes += event.size_in_bytes
+        dest.queue.extend(client, events[:nr_queued], nr_bytes)
+        dest.queue_bytes += nr_bytes
+
+    # events that didn't fit are dropped, and the drop record needs flushing too
+    _mark_pending(dest, nr_queued, nr_bytes)
+    metrics.events_accepted.inc(nr_queued)
+    return nr_queued
+
+
+def run_request_loop(
+    listen_sock, read_timeout=READ_TIMEOUT_SECS, dgram_sock=None, wakeup_sock=None
+):
+    """
+    Serve all client connections from one thread, multiplexed with selectors,
+    along with datagram requests on @dgram_sock, if given.
+    Connections which don't make progress for @read_timeout seconds are closed.
+    Returns once a stop signal is received, having closed the sockets; data
+    sent to @wakeup_sock, if given, wakes the loop to check for one.
+    """
+    listen_sock.setblocking(False)
+    sel = selectors.DefaultSelector()
+    sel.register(listen_sock, selectors.EVENT_READ)
+    if dgram_sock is not None:
+        dgram_sock.setblocking(False)
+        # have the kernel attach each sender's credentials
+        dgram_sock.setsockopt(socket.SOL_SOCKET, socket.SO_PASSCRED, 1)
+        sel.register(dgram_sock, selectors.EVENT_READ)
+    if wakeup_sock is not None:
+        sel.register(wakeup_sock, selectors.EVENT_READ)
+    dgram_buf = bytearray(MAX_DGRAM_BYTES + 1)
+    last_expiry_check = time.monotonic()
+
+    while not _g_nr_stop_signals:
+        for key, mask in sel.select(timeout=1):
+            if key.fileobj is listen_sock:
+                _accept_connection(sel, listen_sock)
+            elif key.fileobj is dgram_sock:
+                _read_datagrams(dgram_sock, dgram_buf)
+            elif key.fileobj is wakeup_sock:
+                try:
+                    wakeup_sock.recv(RECV_BUFSIZE)
+                except BlockingIOError:
+                    pass
+            else:
+                _service_connection(sel, key.data, mask)
+
+        now = time.monotonic()
+        if now - last_expiry_check >= 1:
+            last_expiry_check = now
+            _expire_connections(sel, now - read_timeout)
+            if _g_rate_limiter is not None:
+                _g_rate_limiter.prune()
+            _reclaim_destinations(now)
+
+    _stop_serving(sel, listen_sock, dgram_sock, dgram_buf)
+
+
+def _accept_connection(sel, listen_sock):
+    try:
+        sock, addr = listen_sock.accept()
+    except OSError:
+        return
+    _log.debug("accepted connection")
+    sock.setblocking(False)
+    conn = ClientConnection(sock, clients.peer_client(sock, _g_client_key))
+    sel.register(sock, conn.selector_events, conn)
+
+
+def _read_datagrams(dgram_sock, buf):
+    """
+    Returns: True if there may be more datagrams waiting
+    """
+    # bounded, so that stream clients aren't starved by a datagram flood
+    for _ in range(1000):
         try:
-            try:
-                sock, addr = listen_sock.accept()
-            except OSError:
-                continue
-            try:
-                _log.debug("accepted connection")
-                do_request(sock)
-            finally:
-                sock.close()
+            nr_bytes, ancdata, _, _ = dgram_sock.recvmsg_into(
+                [buf], clients.CREDENTIALS_BUFSIZE
+            )
+        except BlockingIOError:
+            return False
+        except OSError:
+            _log.exception("unhandled in run_request_loop!")
+            return False
+        if nr_bytes > MAX_DGRAM_BYTES:
+            _log.error("datagram request too large")
+            _count_dropped(_g_default, 1)
+            continue
+        do_datagram(
+            bytes(buf[:nr_bytes]), clients.datagram_client(ancdata, _g_client_key)
+        )
+    return True
+
+
+def _service_connection(sel, conn, mask):
+    try:
+        if mask & selectors.EVENT_WRITE:
+            conn.on_writable()
+        if mask & selectors.EVENT_READ:
+            if not conn.on_readable():
+                _close_connection(sel, conn)
+                return
+    except BlockingIOError:
+        pass
+    except Exception:
+        # Should not happen often; we try to forward all exceptions
+        # Should only happen if client dies during request
+        _log.exception("unhandled in run_request_loop!")
+        _close_connection(sel, conn)
+        return
+    sel.modify(conn.sock, conn.selector_events, conn)
+
+
+def _expire_connections(sel, deadline):
+    expired = [
+        key.data
+        for key in sel.get_map().values()
+        if key.data is not None and key.data.last_active < deadline
+    ]
+    for conn in expired:
+        _log.debug("closing timed out connection")
+        _close_connection(sel, conn)
+
+
+def _close_connection(sel, conn):
+    sel.unregister(conn.sock)
+    conn.sock.close()
+
+
+def _stop_serving(sel, listen_sock, dgram_sock, dgram_buf):
+    """
+    Stop accepting connections and datagrams, and queue the requests already
+    received, as far as that's possible without waiting. Requests on each
+    connection get responses if the client is still reading, and then the
+    connection is closed.
+    """
+    _log.info("stopping request loop")
+    sel.unregister(listen_sock)
+    listen_sock.close()
+    if dgram_sock is not None:
+        while _read_datagrams(dgram_sock, dgram_buf):
+            pass
+        sel.unregister(dgram_sock)
+        dgram_sock.close()
+    for key in list(sel.get_map().values()):
+        conn = key.data
+        if conn is None:
+            continue
+        try:
+            conn.on_readable()
         except Exception:
-            # Should not happen often; we try to forward all exceptions
-            # Should only happen if client dies during request
-            _log.exception("unhandled in socket_thread_main!")
+            # nothing more to read, or the client is gone
+            pass
+        _close_connection(sel, conn)
+    sel.close()
+
+
+def _on_stop_signal(signum, frame):
+    # the request loop notices and returns, see serve(); a second signal
+    # cuts short the uploads at shutdown
+    global _g_nr_stop_signals
+    _g_nr_stop_signals += 1
+
+
+def _handle_stop_signals():
+    """
+    Handle SIGTERM and SIGINT by stopping the request loop.
+    Returns: a socket which the signals wake the request loop through
+    """
+    wakeup_sock, signal_sock = socket.socketpair()
+    wakeup_sock.setblocking(False)
+    signal_sock.setblocking(False)
+    signal.set_wakeup_fd(signal_sock.fileno())
+    for signum in (signal.SIGTERM, signal.SIGINT):
+        signal.signal(signum, _on_stop_signal)
+    # the sockets must stay open as long as the handlers are installed
+    _g_wakeup_socks.extend((wakeup_sock, signal_sock))
+    return wakeup_sock
+
+
+def shutdown(timeout=SHUTDOWN_TIMEOUT_SECS):
+    """
+    Upload the events queued in memory as fast as possible, for up to
+    @timeout seconds or until a second stop signal, and then spill whatever
+    is left, in memory or being uploaded, to disk, to be uploaded on the next
+    start. Spooled events are already on disk, and are left there.
+    Must be called once the request loop has stopped.
+    """
+    global _g_stopping
+    start = time.monotonic()
+    with _g_lock:
+        _g_stopping = True
+        dests = list(_g_destinations.values())
+        for dest in dests:
+            dest.flush_cond.notify()
+    _log.info("shutting down, uploading queued events for up to %ds", timeout)
+    for dest in dests:
+        if dest.spool is None and dest.writer is not None:
+            dest.writer.grow_upload_threads(SHUTDOWN_UPLOAD_THREADS)
+
+    deadline = start + timeout
+    while time.monotonic() < deadline and _g_nr_stop_signals < 2:
+        with _g_lock:
+            if all(_is_flushed(dest) for dest in dests):
+                break
+        time.sleep(0.05)
+
+    nr_spilled = 0
+    with _g_lock:
+        # flush and upload threads wait on the lock from here on
+        for dest in dests:
+            nr_spilled += _spill(dest)
+    _log.info(
+        "shut down in %.1fs, spilled %d events", time.monotonic() - start, nr_spilled
+    )
+    for sink in _g_sinks:
+        sink.close()
+
+
+def _is_flushed(dest):
+    """
+    Returns: whether @dest has nothing left to upload which isn't on disk
+    Must be called with _g_lock held
+    """
+    if dest.spool is not None:
+        # anything else is spilled to the spool in no time
+        return True
+    return not dest.queue and not dest.uploading_events and not dest.nr_dropped
+
+
+def _spill(dest):
+    """
+    Write the events of @dest not yet uploaded to its spool, or else to its
+    spill directory, along with a drop event for any drops not yet reported
+    Must be called with _g_lock held
+    Returns: the number of events written
+    """
+    events, _ = dest.queue.drain()
+    for uploading in dest.uploading_events.values():
+        events.extend(uploading)
+    dest.uploading_events.clear()
+    if dest.nr_dropped:
+        events.append(_get_drop_event(dest.nr_dropped))
+        dest.nr_dropped = 0
+    if not events and dest.spool is None:
+        return 0
+
+    try:
+        target = dest.spool
+        if target is None:
+            if dest.spill is None:
+                dest.spill = spool.Spool(_spill_path(dest, dest is _g_default))
+            target = dest.spill
+        nr_written = target.append(events)
+        target.seal()
+        target.sync()
+    except Exception as e:
+        _log.error(
+            "can't spill %d events of %s %s: %r",
+            len(events),
+            dest.group_name,
+            dest.stream_name,
+            e,
+        )
+        return 0
+    if nr_written < len(events):
+        _log.error(
+            "no room to spill %d events of %s %s",
+            len(events) - nr_written,
+            dest.group_name,
+            dest.stream_name,
+        )
+    return nr_written
 
 
 def main():
@@ -209,20 +1402,78 @@ def main():
     _print("cwlogs: starting...")
     _log.info("starting")
 
-    listen_sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM, 0)
-    addr = "\0org.globus.cwlogs"
+    # under systemd, the sockets stay open, queueing requests, across
+    # restarts; otherwise, bind them here
+    listen_sock, dgram_sock = _activated_sockets()
+    if listen_sock is None:
+        listen_sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM, 0)
+        try:
+            listen_sock.bind(LISTEN_ADDR)
+        except OSError as e:
+            if e.errno == errno.EADDRINUSE:
+                _print("cwlogs: already running")
+                return
+            else:
+                raise
+        listen_sock.listen(SOCK_LISTEN_BACKLOG)
+
+    if dgram_sock is None:
+        dgram_sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM, 0)
+        dgram_sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, DGRAM_RCVBUF_BYTES)
+        dgram_sock.bind(DGRAM_ADDR)
+
+    _print("cwlogs: started ok")
+
+    serve(listen_sock, dgram_sock)
+    _print("cwlogs: stopped")
+
+
+def _activated_sockets():
+    """
+    Take the sockets systemd passed the daemon by socket activation, if any,
+    and unset the environment variables which pass them.
+    Returns: the listening stream socket and the datagram socket, either of
+             which is None if not passed
+    """
     try:
-        listen_sock.bind(addr)
-    except OSError as e:
-        if e.errno == errno.EADDRINUSE:
-            _print("cwlogs: already running")
-            return
+        listen_pid = int(os.environ.pop("LISTEN_PID"))
+        nr_fds = int(os.environ.pop("LISTEN_FDS"))
+    except (KeyError, ValueError):
+        return None, None
+    finally:
+        os.environ.pop("LISTEN_FDNAMES", None)
+    if listen_pid != os.getpid():
+        # meant for another process
+        return None, None
+
+    listen_sock = dgram_sock = None
+    for fd in range(SD_LISTEN_FDS_START, SD_LISTEN_FDS_START + nr_fds):
+        # socket.socket(fileno=fd) only detects the family and type from the
+        # fd from python3.7, so read them through a probe on a dup of it
+        probe = socket.fromfd(fd, socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            family = probe.getsockopt(socket.SOL_SOCKET, socket.SO_DOMAIN)
+            sock_type = probe.getsockopt(socket.SOL_SOCKET, socket.SO_TYPE)
+        finally:
+            probe.close()
+        sock = socket.socket(family, sock_type, 0, fd)
+        if family == socket.AF_UNIX and sock_type == socket.SOCK_STREAM:
+            listen_sock = sock
+        elif family == socket.AF_UNIX and sock_type == socket.SOCK_DGRAM:
+            dgram_sock = sock
         else:
-            raise
+            _log.warning("ignoring unexpected socket %r from systemd", sock)
+            sock.close()
+    _log.info("using %d sockets from systemd", nr_fds)
+    return listen_sock, dgram_sock
 
-    _print("cwlogs: started ok")
-    listen_sock.listen(SOCK_LISTEN_BACKLOG)
 
+def serve(listen_sock, dgram_sock=None):
+    """
+    Configure the daemon from /etc/cwlogd.ini, start the flush threads, and
+    serve requests from the bound sockets until SIGTERM or SIGINT, then shut
+    down
+    """
     try:
         stream_name = config.get_string("stream_name")
     except KeyError:
@@ -239,6 +1490,11 @@ def main():
     except KeyError:
         aws_region = None
 
+    try:
+        endpoint_url = config.get_string("endpoint_url")
+    except KeyError:
+        endpoint_url = None
+
     try:
         group_name = config.get_string("group_name")
     except KeyError:
@@ -247,13 +1503,205 @@ def main():
             "run globus_cw_daemon_install?"
         )
 
-    writer = cwlogs.LogWriter(group_name, stream_name, aws_region=aws_region)
+    try:
+        read_timeout = config.get_int("read_timeout")
+    except KeyError:
+        read_timeout = READ_TIMEOUT_SECS
 
-    flush_thread = threading.Thread(target=flush_thread_main, args=(writer,))
-    flush_thread.daemon = True
-    flush_thread.start()
+    try:
+        nr_streams = config.get_int("upload_streams")
+    except KeyError:
+        nr_streams = 1
+
+    global _g_spool_dir, _g_spool_max_bytes
+    try:
+        _g_spool_dir = config.get_string("spool_dir")
+    except KeyError:
+        pass
+    try:
+        _g_spool_max_bytes = config.get_int("spool_max_bytes")
+    except KeyError:
+        pass
+
+    global _g_spill_dir
+    try:
+        _g_spill_dir = config.get_string("spill_dir")
+    except KeyError:
+        pass
+    try:
+        shutdown_timeout = config.get_int("shutdown_timeout")
+    except KeyError:
+        shutdown_timeout = SHUTDOWN_TIMEOUT_SECS
+
+    global _g_sink_mode
+    try:
+        _g_sink_mode = config.get_string("sink_mode")
+    except KeyError:
+        pass
+    if _g_sink_mode not in sinks.SINK_MODES:
+        raise Exception(f"sink_mode must be one of {sinks.SINK_MODES}")
+    try:
+        sink_fallback_secs = config.get_int("sink_fallback_secs")
+    except KeyError:
+        sink_fallback_secs = sinks.FALLBACK_SECS
+    try:
+        file_sink_dir = config.get_string("file_sink_dir")
+    except KeyError:
+        file_sink_dir = None
+    if file_sink_dir:
+        try:
+            file_sink_max_bytes = config.get_int("file_sink_max_bytes")
+        except KeyError:
+            file_sink_max_bytes = sinks.FILE_MAX_BYTES
+        try:
+            file_sink_max_files = config.get_int("file_sink_max_files")
+        except KeyError:
+            file_sink_max_files = sinks.FILE_MAX_FILES
+        try:
+            file_sink_max_age_secs = config.get_int("file_sink_max_age_secs")
+        except KeyError:
+            file_sink_max_age_secs = sinks.FILE_MAX_AGE_SECS
+        _g_sinks.append(
+            sinks.FileSink(
+                file_sink_dir,
+                file_sink_max_bytes,
+                file_sink_max_files,
+                file_sink_max_age_secs,
+            )
+        )
+    try:
+        journald_sink = config.get_bool("journald_sink")
+    except KeyError:
+        journald_sink = False
+    if journald_sink:
+        _g_sinks.append(sinks.JournaldSink())
+
+    global _g_max_destinations, _g_destination_idle_secs
+    global _g_allowed_groups, _g_allowed_streams
+    try:
+        _g_max_destinations = config.get_int("max_destinations")
+    except KeyError:
+        pass
+    try:
+        _g_destination_idle_secs = config.get_int("destination_idle_secs")
+    except KeyError:
+        pass
+    try:
+        _g_allowed_groups = _parse_patterns(config.get_string("allowed_groups"))
+    except KeyError:
+        pass
+    try:
+        _g_allowed_streams = _parse_patterns(config.get_string("allowed_streams"))
+    except KeyError:
+        pass
 
-    run_request_loop(listen_sock)
+    global _g_client_key, _g_rate_limiter
+    try:
+        _g_client_key = config.get_string("client_key")
+    except KeyError:
+        pass
+    if _g_client_key not in clients.CLIENT_KEYS:
+        raise Exception(f"client_key must be one of {clients.CLIENT_KEYS}")
+    try:
+        client_rate_limit = config.get_int("client_rate_limit")
+    except KeyError:
+        client_rate_limit = None
+    if client_rate_limit is not None:
+        try:
+            client_rate_burst = config.get_int("client_rate_burst")
+        except KeyError:
+            client_rate_burst = client_rate_limit * clients.RATE_BURST_SECS
+        _g_rate_limiter = clients.RateLimiter(client_rate_limit, client_rate_burst)
+
+    global _g_max_queue_bytes
+    try:
+        _g_max_queue_bytes = config.get_int("max_queue_bytes")
+    except KeyError:
+        pass
+
+    global _g_flush_batch_bytes, _g_flush_batch_records, _g_flush_max_latency
+    try:
+        _g_flush_batch_bytes = config.get_int("flush_batch_bytes")
+    except KeyError:
+        pass
+    try:
+        _g_flush_batch_records = config.get_int("flush_batch_records")
+    except KeyError:
+        pass
+    try:
+        _g_flush_max_latency = config.get_int("flush_max_latency_ms") / 1000
+    except KeyError:
+        pass
+
+    try:
+        nr_threads = config.get_int("upload_threads")
+    except KeyError:
+        nr_threads = None
+
+    try:
+        sequence_tokens = config.get_bool("sequence_tokens")
+    except KeyError:
+        sequence_tokens = False
+
+    try:
+        compress = config.get_bool("compress_uploads")
+    except KeyError:
+        compress = False
+
+    try:
+        metrics_port = config.get_int("metrics_port")
+    except KeyError:
+        metrics_port = None
+    if metrics_port is not None:
+        metrics.serve(metrics_port)
+
+    _g_writer_kwargs.update(
+        aws_region=aws_region,
+        nr_streams=nr_streams,
+        endpoint_url=endpoint_url,
+        compress=compress,
+        sequence_tokens=sequence_tokens,
+        nr_threads=nr_threads,
+    )
+    if _g_sinks and _g_sink_mode == "fallback":
+        _g_writer_kwargs.update(fallback=_write_sinks, fallback_secs=sink_fallback_secs)
+    # unlike other destinations, the default one must work from the start
+    writer = cwlogs.LogWriter(group_name, stream_name, **_g_writer_kwargs)
+
+    default_spool = None
+    if _g_spool_dir:
+        default_spool = spool.Spool(_g_spool_dir, max_bytes=_g_spool_max_bytes)
+    _add_destination(
+        group_name, stream_name, writer=writer, dest_spool=default_spool, default=True
+    )
+    for root in (_g_spool_dir, _g_spill_dir):
+        if not root:
+            continue
+        for dest_group_name, dest_stream_name in _stored_destinations(root):
+            try:
+                _add_destination(dest_group_name, dest_stream_name)
+            except Exception as e:
+                _log.error(
+                    "can't replay events of %s %s from %s: %r",
+                    dest_group_name,
+                    dest_stream_name,
+                    root,
+                    e,
+                )
+
+    if _g_spool_dir:
+        syncer_thread = threading.Thread(target=syncer_thread_main)
+        syncer_thread.daemon = True
+        syncer_thread.start()
+
+    wakeup_sock = _handle_stop_signals()
+    run_request_loop(
+        listen_sock,
+        read_timeout=read_timeout,
+        dgram_sock=dgram_sock,
+        wakeup_sock=wakeup_sock,
+    )
+    shutdown(shutdown_timeout)
 
 
 if __name__ == "__main__":
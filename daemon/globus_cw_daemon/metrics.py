@@ -0,0 +1,267 @@
+"""
+Daemon metrics, served over HTTP in the Prometheus text format.
+
+Unlike the health info in replies and the heartbeat events, these are
+visible even when CloudWatch Logs is unreachable, so alerts on backlog can
+fire before events are dropped.
+"""
+import bisect
+import http.server
+import logging
+import socketserver
+import threading
+import typing
+
+# Served on 127.0.0.1 only; the port is set by metrics_port in /etc/cwlogd.ini
+METRICS_HOST = "127.0.0.1"
+
+_CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+_log = logging.getLogger(__name__)
+
+# Protects the values of all metrics
+_lock = threading.Lock()
+_registry: typing.List[typing.Any] = []
+
+
+class Counter:
+    """
+    A count which only goes up, optionally split by the value of one label
+    """
+
+    def __init__(self, name, help, label=None):
+        self.name = name
+        self.help = help
+        self.label = label
+        self._values = {} if label else {None: 0}
+        _registry.append(self)
+
+    def inc(self, amount=1, label_value=None):
+        with _lock:
+            self._values[label_value] = self._values.get(label_value, 0) + amount
+
+    def get(self, label_value=None):
+        with _lock:
+            return self._values.get(label_value, 0)
+
+    def _samples(self):
+        for label_value, value in sorted(self._values.items(), key=_by_label):
+            yield self.name, _labels(self.label, label_value), value
+
+
+class Gauge:
+    """
+    A value read by calling @fn whenever metrics are collected
+    """
+
+    def __init__(self, name, help, fn):
+        self.name = name
+        self.help = help
+        self._fn = fn
+        _registry.append(self)
+
+    def _samples(self):
+        yield self.name, "", self._fn()
+
+
+class Histogram:
+    """
+    Counts of observed values, by upper bound
+    """
+
+    def __init__(self, name, help, buckets):
+        self.name = name
+        self.help = help
+        self._bounds = sorted(buckets)
+        self._counts = [0] * (len(self._bounds) + 1)
+        self._sum = 0.0
+        _registry.append(self)
+
+    def observe(self, value):
+        with _lock:
+            self._counts[bisect.bisect_left(self._bounds, value)] += 1
+            self._sum += value
+
+    def _samples(self):
+        total = 0
+        for bound, count in zip(self._bounds, self._counts):
+            total += count
+            yield self.name + "_bucket", _labels("le", repr(float(bound))), total
+        total += self._counts[-1]
+        yield self.name + "_bucket", _labels("le", "+Inf"), total
+        yield self.name + "_sum", "", self._sum
+        yield self.name + "_count", "", total
+
+
+def _by_label(item):
+    return "" if item[0] is None else str(item[0])
+
+
+def _labels(name, value):
+    if name is None or value is None:
+        return ""
+    value = str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+    return f'{{{name}="{value}"}}'
+
+
+def _type_name(metric):
+    return {Counter: "counter", Gauge: "gauge", Histogram: "histogram"}[type(metric)]
+
+
+def render():
+    """
+    Returns: every metric in the Prometheus text format, as utf8 bytes
+    """
+    lines = []
+    for metric in _registry:
+        lines.append(f"# HELP {metric.name} {metric.help}")
+        lines.append(f"# TYPE {metric.name} {_type_name(metric)}")
+        if isinstance(metric, Gauge):
+            # gauges read daemon state, which has its own locking
+            samples = list(metric._samples())
+        else:
+            with _lock:
+                samples = list(metric._samples())
+        for name, labels, value in samples:
+            lines.append(f"{name}{labels} {value}")
+    return ("\n".join(lines) + "\n").encode("utf-8")
+
+
+class _Handler(http.server.BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split("?")[0] not in ("/", "/metrics"):
+            self.send_error(404)
+            return
+        try:
+            body = render()
+        except Exception as e:
+            _log.exception("error rendering metrics")
+            self.send_error(500, explain=repr(e))
+            return
+        self.send_response(200)
+        self.send_header("Content-Type", _CONTENT_TYPE)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        _log.debug("metrics request: " + format, *args)
+
+
+class _Server(socketserver.ThreadingMixIn, http.server.HTTPServer):
+    # as http.server.ThreadingHTTPServer, which needs python3.7
+    daemon_threads = True
+
+
+def serve(port, host=METRICS_HOST):
+    """
+    Serve /metrics on @host:@port from a background thread.
+    Returns: the server, already serving
+    """
+    server = _Server((host, port), _Handler)
+    thread = threading.Thread(target=server.serve_forever, name="cwlogs-metrics")
+    thread.daemon = True
+    thread.start()
+    _log.info("serving metrics on %s:%d", host, server.server_address[1])
+    return server
+
+
+# Metrics which aren't tied to daemon state are defined here, so that any
+# module can update them
+events_accepted = Counter(
+    "cwlogs_events_accepted_total", "Events accepted from clients and queued"
+)
+events_rate_limited = Counter(
+    "cwlogs_events_rate_limited_total",
+    "Events refused because their client was over its rate limit, also "
+    "counted as refused or dropped",
+)
+events_refused = Counter(
+    "cwlogs_events_refused_total",
+    "Events given a busy status because the queue was full or their client "
+    "was over its rate limit, which clients retry; counted again if refused "
+    "again",
+)
+events_dropped = Counter(
+    "cwlogs_events_dropped_total",
+    "Events lost: sent without acknowledgement, and refused or invalid",
+)
+batches_flushed = Counter(
+    "cwlogs_batches_flushed_total", "Batches uploaded to CloudWatch Logs"
+)
+events_flushed = Counter(
+    "cwlogs_events_flushed_total", "Events uploaded to CloudWatch Logs"
+)
+bytes_flushed = Counter(
+    "cwlogs_bytes_flushed_total",
+    "Event bytes uploaded to CloudWatch Logs, as counted against AWS limits",
+)
+put_log_events_seconds = Histogram(
+    "cwlogs_put_log_events_seconds",
+    "Time taken by each PutLogEvents call, including failed ones",
+    [0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30],
+)
+put_log_events_retries = Counter(
+    "cwlogs_put_log_events_retries_total",
+    "PutLogEvents calls which failed and were retried, by exception type",
+    label="exception",
+)
+events_rejected = Counter(
+    "cwlogs_events_rejected_total",
+    "Events not stored by CloudWatch Logs, because they were too old, too new "
+    "or expired, their batch failed with a permanent error, or their log "
+    "group can't be written to",
+    label="reason",
+)
+destinations_removed = Counter(
+    "cwlogs_destinations_removed_total",
+    "Destinations removed, freeing their slot, because they were idle or "
+    "their log group can't be written to",
+    label="reason",
+)
+sequence_token_resyncs = Counter(
+    "cwlogs_sequence_token_resyncs_total",
+    "Sequence tokens taken from InvalidSequenceTokenException errors",
+)
+gzip_input_bytes = Counter(
+    "cwlogs_gzip_input_bytes_total", "PutLogEvents body bytes before gzip"
+)
+gzip_output_bytes = Counter(
+    "cwlogs_gzip_output_bytes_total", "PutLogEvents body bytes after gzip"
+)
+gzip_cpu_seconds = Counter(
+    "cwlogs_gzip_cpu_seconds_total",
+    "CPU time spent gzip'ing PutLogEvents bodies (wall time before python3.7)",
+)
+gzip_fallbacks = Counter(
+    "cwlogs_gzip_fallbacks_total",
+    "Times the service rejected a gzip'd body, so that uploads were no longer "
+    "compressed",
+)
+pipeline_blocked_seconds = Counter(
+    "cwlogs_pipeline_blocked_seconds_total",
+    "Time each upload pipeline stage spent waiting for the next one to make "
+    "room: submit (the flush threads) waiting on batching, and batch waiting "
+    "on uploads",
+    label="stage",
+)
+sink_events = Counter(
+    "cwlogs_sink_events_total",
+    "Events written to local sinks, by sink",
+    label="sink",
+)
+sink_errors = Counter(
+    "cwlogs_sink_errors_total",
+    "Writes to local sinks which failed, by sink",
+    label="sink",
+)
+events_fallen_back = Counter(
+    "cwlogs_events_fallen_back_total",
+    "Events whose uploads were given up on once they were written to local "
+    "sinks, with sink_mode = fallback",
+)
+flush_lag_seconds = Histogram(
+    "cwlogs_flush_lag_seconds",
+    "How long the oldest event of each flush waited to be picked up",
+    [0.1, 0.25, 0.5, 1, 2, 5, 10, 30, 60, 300],
+)
@@ -0,0 +1,290 @@
+"""
+Local sinks, which keep events on this host as well as, or instead of, in
+CloudWatch Logs: a file sink, which appends to rotating files whose contents
+globus_cw_daemon_backfill can upload later, and a journald sink.
+
+With sink_mode = tee in /etc/cwlogd.ini, every event flushed is also written
+to the sinks. With sink_mode = fallback, only batches which uploads have
+failed for sink_fallback_secs are, and the uploads are then given up on, as
+are batches failing with a permanent error.
+
+A sink has a write(group_name, stream_name, events) method, which raises on
+failure, and a close() method; both may be called from any thread.
+"""
+import errno
+import fcntl
+import gzip
+import logging
+import os
+import shutil
+import socket
+import struct
+import threading
+import time
+import urllib.parse
+
+# When events are written to the sinks, unless overridden by sink_mode
+SINK_MODES = ("tee", "fallback")
+SINK_MODE = "fallback"
+
+# Unless overridden by sink_fallback_secs in /etc/cwlogd.ini
+FALLBACK_SECS = 300
+
+# Unless overridden by file_sink_max_bytes, file_sink_max_age_secs and
+# file_sink_max_files: the file being written is rotated at this size, or
+# once it has been open this long, and this many rotated files are kept for
+# each destination
+FILE_MAX_BYTES = 64 * 1024 * 1024
+FILE_MAX_AGE_SECS = 300
+FILE_MAX_FILES = 10
+
+# The file being written, in each destination's directory; rotated files are
+# named by the time they were rotated, in ns, and gzip'd. Only rotated files
+# are complete, for globus_cw_daemon_backfill to upload
+CURRENT_FILE = "current.jsonl"
+ROTATED_SUFFIX = ".jsonl.gz"
+
+JOURNAL_SOCKET = "/run/systemd/journal/socket"
+JOURNAL_IDENTIFIER = "globus_cw_daemon"
+# Sends to journald, whose socket has a short queue, fail after waiting this
+# long for it to make room, rather than holding up uploads
+JOURNAL_TIMEOUT_SECS = 5
+
+_log = logging.getLogger(__name__)
+
+
+def destination_dir(root, group_name, stream_name):
+    """
+    Returns: the directory under @root of the destination's files, with
+    names %-quoted
+    """
+    return os.path.join(
+        root,
+        urllib.parse.quote(group_name, safe=""),
+        urllib.parse.quote(stream_name, safe=""),
+    )
+
+
+class FileSink:
+    """
+    Appends events, as JSON lines of the PutLogEvents event fields, to a file
+    for each destination. A file which reaches @max_bytes, or has been open
+    for @max_age_secs, is rotated: gzip'd, with the oldest gzip'd files
+    deleted once there are more than @max_files. Files are flushed after each
+    write, but not fsync'd.
+    """
+
+    name = "file"
+
+    def __init__(
+        self,
+        path,
+        max_bytes=FILE_MAX_BYTES,
+        max_files=FILE_MAX_FILES,
+        max_age_secs=FILE_MAX_AGE_SECS,
+    ):
+        if max_bytes < 1 or max_files < 1 or max_age_secs <= 0:
+            raise ValueError("max_bytes, max_files and max_age_secs must be positive")
+        self.path = path
+        self.max_bytes = max_bytes
+        self.max_files = max_files
+        self.max_age_secs = max_age_secs
+        self._lock = threading.Lock()
+        # (group_name, stream_name) -> the open current file, and when it was
+        # opened
+        self._files = {}
+        self._opened = {}
+        self._stop = threading.Event()
+        self._thread = threading.Thread(
+            target=self._rotate_main, name="file-sink-rotate", daemon=True
+        )
+        self._thread.start()
+
+    def write(self, group_name, stream_name, events):
+        data = b"".join(
+            b'{"timestamp": %d, "message": %s}\n' % (e.timestamp, e.json_message)
+            for e in events
+        )
+        key = (group_name, stream_name)
+        rotated = None
+        with self._lock:
+            f = self._files.get(key)
+            if f is None:
+                path = destination_dir(self.path, group_name, stream_name)
+                os.makedirs(path, mode=0o700, exist_ok=True)
+                f = open(os.path.join(path, CURRENT_FILE), "ab")
+                self._files[key] = f
+                self._opened[key] = time.time()
+            f.write(data)
+            f.flush()
+            if f.tell() >= self.max_bytes:
+                rotated = self._detach(key)
+        if rotated is not None:
+            self._finish_rotation(rotated)
+
+    def rotate(self, opened_before=None):
+        """
+        Rotate the files opened before the time @opened_before, or all of
+        them if None
+        """
+        with self._lock:
+            rotated = [
+                self._detach(key)
+                for key, opened in list(self._opened.items())
+                if opened_before is None or opened < opened_before
+            ]
+        for path in rotated:
+            self._finish_rotation(path)
+
+    def close(self):
+        """
+        Rotate all the files, so that globus_cw_daemon_backfill can upload
+        them without waiting for the daemon to write to them again
+        """
+        self._stop.set()
+        self._thread.join()
+        self.rotate()
+
+    def _rotate_main(self):
+        interval = min(self.max_age_secs, 60)
+        while not self._stop.wait(interval):
+            try:
+                self.rotate(time.time() - self.max_age_secs)
+            except Exception:
+                _log.exception("error rotating file sink files")
+
+    def _detach(self, key):
+        """
+        Close the current file of destination @key, and rename it for
+        rotation; done under the lock, so that writes carry on in a new file
+        while this one is compressed
+        Returns: its new path
+        """
+        f = self._files.pop(key)
+        del self._opened[key]
+        f.close()
+        path = os.path.dirname(f.name)
+        # named in us rather than ns, which python3.6 has no clock for, made
+        # unique should two files be rotated within one
+        ns = int(time.time() * 1e6) * 1000
+        while True:
+            rotated = os.path.join(path, f"{ns:020d}.jsonl")
+            if not os.path.exists(rotated) and not os.path.exists(rotated + ".gz"):
+                break
+            ns += 1
+        os.rename(f.name, rotated)
+        return rotated
+
+    def _finish_rotation(self, path):
+        _compress(path)
+        self._prune(os.path.dirname(path))
+
+    def _prune(self, path):
+        rotated = sorted(
+            name for name in os.listdir(path) if name.endswith(ROTATED_SUFFIX)
+        )
+        for name in rotated[: -self.max_files]:
+            _log.warning("file sink full, deleting %s", os.path.join(path, name))
+            os.unlink(os.path.join(path, name))
+
+
+def _compress(path):
+    """
+    Replace the file at @path with a gzip'd copy, named with a .gz suffix
+    """
+    with open(path, "rb") as src, gzip.open(path + ".gz.tmp", "wb") as dst:
+        shutil.copyfileobj(src, dst)
+    os.rename(path + ".gz.tmp", path + ".gz")
+    os.unlink(path)
+
+
+class JournaldSink:
+    """
+    Sends each event to journald as an entry of its own, over its native
+    protocol. The entry's MESSAGE is the event's message; the destination is
+    in the CWLOGS_GROUP and CWLOGS_STREAM fields, and the event's timestamp,
+    in ms, in CWLOGS_TIMESTAMP.
+    """
+
+    name = "journald"
+
+    def __init__(self, path=JOURNAL_SOCKET, identifier=JOURNAL_IDENTIFIER):
+        self.path = path
+        self.identifier = identifier
+        self._sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        self._sock.settimeout(JOURNAL_TIMEOUT_SECS)
+
+    def write(self, group_name, stream_name, events):
+        head = _journal_fields(
+            (
+                ("SYSLOG_IDENTIFIER", self.identifier),
+                ("PRIORITY", "6"),
+                ("CWLOGS_GROUP", group_name),
+                ("CWLOGS_STREAM", stream_name),
+            )
+        )
+        for event in events:
+            entry = head + _journal_fields(
+                (
+                    ("CWLOGS_TIMESTAMP", str(event.timestamp)),
+                    ("MESSAGE", event.unicode_message),
+                )
+            )
+            try:
+                self._sock.sendto(entry, self.path)
+            except OSError as e:
+                if e.errno not in (errno.EMSGSIZE, errno.ENOBUFS):
+                    raise
+                if not hasattr(os, "memfd_create"):
+                    # before python3.8, there's no way to send it as a memfd
+                    raise
+                # too large for a datagram
+                self._send_memfd(entry)
+
+    def close(self):
+        self._sock.close()
+
+    def _send_memfd(self, entry):
+        # the seals journald requires of an entry passed as a memfd; looked
+        # up here, as python3.6 and 3.7 lack them
+        seals = (
+            fcntl.F_SEAL_SHRINK
+            | fcntl.F_SEAL_GROW
+            | fcntl.F_SEAL_WRITE
+            | fcntl.F_SEAL_SEAL
+        )
+        fd = os.memfd_create("cwlogs-journal", os.MFD_ALLOW_SEALING)
+        try:
+            view = memoryview(entry)
+            while view:
+                view = view[os.write(fd, view) :]
+            fcntl.fcntl(fd, fcntl.F_ADD_SEALS, seals)
+            self._sock.sendmsg(
+                [],
+                [(socket.SOL_SOCKET, socket.SCM_RIGHTS, struct.pack("i", fd))],
+                0,
+                self.path,
+            )
+        finally:
+            os.close(fd)
+
+
+def _journal_fields(fields):
+    """
+    Returns: the (name, value) @fields encoded for journald's native protocol,
+    where values holding newlines are length-prefixed
+    """
+    out = []
+    for name, value in fields:
+        value = value.encode("utf-8")
+        if b"\n" in value:
+            out.append(
+                name.encode("ascii")
+                + b"\n"
+                + struct.pack("<Q", len(value))
+                + value
+                + b"\n"
+            )
+        else:
+            out.append(name.encode("ascii") + b"=" + value + b"\n")
+    return b"".join(out)
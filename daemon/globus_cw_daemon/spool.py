@@ -0,0 +1,233 @@
+"""
+Disk-backed spool of events awaiting upload.
+
+Events are appended to the active segment file. The flush thread seals the
+active segment, uploads the events of each sealed segment, and then removes it.
+Segments left behind by a previous run are uploaded first.
+
+Each record in a segment is a little-endian int64 timestamp, a uint32 length,
+and that many bytes of utf8 message. A record cut short by a crash is ignored.
+
+Appended records are written to the OS at once, so they survive the daemon
+crashing, but fsync'd later, by the caller, so that whatever serializes
+access to the spool isn't held up by the disk: take_unsynced() hands over
+the files to fsync with sync_fds(). Records may be lost if the host crashes
+before then.
+"""
+import collections
+import logging
+import os
+import struct
+import typing
+
+import globus_cw_daemon.cwlogs as cwlogs
+
+# Start a new segment once the active one is this large
+SEGMENT_BYTES = 8 * 1024 * 1024
+
+# Unless overridden by spool_max_bytes in /etc/cwlogd.ini
+MAX_SPOOL_BYTES = 1024 * 1024 * 1024
+
+# Writes should be fsync'd in batches, at least this often, and sooner once
+# this many bytes are unsynced
+FSYNC_INTERVAL_SECS = 0.2
+FSYNC_BYTES = 1024 * 1024
+
+_RECORD_HEADER = struct.Struct("<qI")
+_SEGMENT_SUFFIX = ".seg"
+
+_log = logging.getLogger(__name__)
+
+
+class _Segment:
+    def __init__(self, seqno, path, nr_bytes=0, nr_events=0):
+        self.seqno = seqno
+        self.path = path
+        self.nr_bytes = nr_bytes
+        self.nr_events = nr_events
+
+
+class Spool:
+    """
+    Not thread-safe; callers must serialize access.
+    """
+
+    def __init__(self, path, max_bytes=MAX_SPOOL_BYTES):
+        """
+        Use the directory at @path, creating it if needed, and pick up
+        any segments left in it.
+        """
+        self.path = path
+        self.max_bytes = max_bytes
+        os.makedirs(path, mode=0o700, exist_ok=True)
+
+        self._sealed = collections.deque()
+        for name in sorted(os.listdir(path)):
+            if not name.endswith(_SEGMENT_SUFFIX):
+                continue
+            segment = _Segment(int(name[: -len(_SEGMENT_SUFFIX)]), self._join(name))
+            segment.nr_bytes = os.path.getsize(segment.path)
+            segment.nr_events = sum(1 for _ in _read_records(segment.path))
+            if segment.nr_events:
+                self._sealed.append(segment)
+            else:
+                os.unlink(segment.path)
+        if self._sealed:
+            _log.info(
+                "replaying %d spooled events",
+                sum(s.nr_events for s in self._sealed),
+            )
+
+        # totals for all segments not yet removed, including the active one
+        self.nr_events = sum(s.nr_events for s in self._sealed)
+        self.nr_bytes = sum(s.nr_bytes for s in self._sealed)
+
+        self._active = None
+        self._active_file = None
+        self._next_seqno = self._sealed[-1].seqno + 1 if self._sealed else 0
+        # bytes written to the active segment since it was last synced
+        self.nr_unsynced = 0
+        # duplicates of the file descriptors of sealed segments not yet synced
+        self._unsynced_fds: typing.List[int] = []
+
+    def append(self, events):
+        """
+        Write as many of @events as fit within max_bytes, in order.
+        Returns: the number of events written
+        """
+        nr_free = self.max_bytes - self.nr_bytes
+        nr_written = 0
+        for event in events:
+            message = event.unicode_message.encode("utf-8")
+            record_len = _RECORD_HEADER.size + len(message)
+            if record_len > nr_free:
+                break
+            if self._active is None or self._active.nr_bytes >= SEGMENT_BYTES:
+                self._open_segment()
+            self._active_file.write(_RECORD_HEADER.pack(event.timestamp, len(message)))
+            self._active_file.write(message)
+            self._active.nr_bytes += record_len
+            self._active.nr_events += 1
+            self.nr_bytes += record_len
+            self.nr_events += 1
+            self.nr_unsynced += record_len
+            nr_free -= record_len
+            nr_written += 1
+        if nr_written:
+            self._active_file.flush()
+        return nr_written
+
+    def seal(self):
+        """
+        Seal the active segment, if any, so it can be uploaded.
+        """
+        if self._active is not None:
+            self._active_file.flush()
+            if self.nr_unsynced:
+                self._unsynced_fds.append(os.dup(self._active_file.fileno()))
+                self.nr_unsynced = 0
+            self._active_file.close()
+            self._sealed.append(self._active)
+            self._active = None
+            self._active_file = None
+
+    def sealed_segments(self):
+        """
+        Returns: a snapshot of the sealed segments, oldest first
+        """
+        return list(self._sealed)
+
+    def remove(self, segment):
+        """
+        Delete sealed @segment, once its events are safely uploaded.
+        """
+        self._sealed.remove(segment)
+        os.unlink(segment.path)
+        self.nr_bytes -= segment.nr_bytes
+        self.nr_events -= segment.nr_events
+
+    def _open_segment(self):
+        self.seal()
+        self._active = _Segment(
+            self._next_seqno,
+            self._join(f"{self._next_seqno:020d}{_SEGMENT_SUFFIX}"),
+        )
+        self._next_seqno += 1
+        self._active_file = open(self._active.path, "ab")
+
+    def take_unsynced(self):
+        """
+        Returns: file descriptors of the segments written to since the last
+                 call, to pass to sync_fds(), which needn't be serialized
+                 with other Spool access
+        """
+        fds, self._unsynced_fds = self._unsynced_fds, []
+        if self.nr_unsynced:
+            fds.append(os.dup(self._active_file.fileno()))
+            self.nr_unsynced = 0
+        return fds
+
+    def close(self):
+        """
+        Close the spool's files, without syncing them, once it's no longer
+        used; an empty active segment is deleted
+        """
+        fds, self._unsynced_fds = self._unsynced_fds, []
+        for fd in fds:
+            os.close(fd)
+        if self._active is not None:
+            self._active_file.close()
+            if not self._active.nr_events:
+                os.unlink(self._active.path)
+            self._active = None
+            self._active_file = None
+
+    def sync(self):
+        """
+        fsync everything written so far, without handing it over
+        """
+        sync_fds(self.take_unsynced())
+
+    def _join(self, name):
+        return os.path.join(self.path, name)
+
+
+def sync_fds(fds):
+    """
+    fsync, then close, the file descriptors @fds from Spool.take_unsynced()
+    """
+    for fd in fds:
+        try:
+            os.fsync(fd)
+        except OSError as e:
+            _log.error("can't fsync spool segment: %r", e)
+        finally:
+            os.close(fd)
+
+
+def read_segment(segment):
+    """
+    Returns: the list of Events in sealed @segment.
+    May be called without serializing with other Spool access.
+    """
+    events = []
+    for timestamp, message in _read_records(segment.path):
+        try:
+            events.append(cwlogs.Event(timestamp, message, enforce_limit=False))
+        except Exception as e:
+            _log.error("skipping bad record in %s: %r", segment.path, e)
+    return events
+
+
+def _read_records(path):
+    with open(path, "rb") as f:
+        data = f.read()
+    offset = 0
+    while offset + _RECORD_HEADER.size <= len(data):
+        timestamp, length = _RECORD_HEADER.unpack_from(data, offset)
+        offset += _RECORD_HEADER.size
+        if offset + length > len(data):
+            _log.warning("ignoring truncated record in %s", path)
+            return
+        yield timestamp, data[offset : offset + length]
+        offset += length
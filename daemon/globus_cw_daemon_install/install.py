@@ -2,7 +2,8 @@
 Install script for globus_cw_daemon, assumes being run on Ubuntu ec2 instance
 Given a group_name and an optional stream_name as arguments:
 - Creates config file at at /etc/cwlogd.ini
-- Copies globus_cw_daemon.service to /etc/systemd/system/
+- Copies globus_cw_daemon.service and globus_cw_daemon.socket to
+  /etc/systemd/system/
 """
 import argparse
 import configparser
@@ -32,12 +33,108 @@ def main():
     parser.add_argument(
         "--no-heartbeats", action="store_true", help="Turn off heartbeats."
     )
+    parser.add_argument(
+        "--upload-streams",
+        type=int,
+        help="Upload concurrently to this many log streams, named "
+        "<stream-name>-0, <stream-name>-1, etc. Default is 1, which uploads to "
+        "<stream-name> itself.",
+    )
+    parser.add_argument(
+        "--upload-threads",
+        type=int,
+        help="Upload this many batches at once, across all log streams. "
+        "Default is one per log stream.",
+    )
+    parser.add_argument(
+        "--sequence-tokens",
+        action="store_true",
+        help="Pass sequence tokens to PutLogEvents, which allows only one "
+        "upload at a time to each log stream. Only for compatibility, since "
+        "CloudWatch Logs no longer requires them.",
+    )
+    parser.add_argument(
+        "--compress-uploads",
+        action="store_true",
+        help="Upload gzip'd request bodies to CloudWatch Logs, falling back "
+        "to uncompressed ones if they're rejected.",
+    )
+    parser.add_argument(
+        "--client-rate-limit",
+        type=int,
+        help="Accept at most this many events per second from each client "
+        "process, telling it to retry any more later. Default is no limit.",
+    )
+    parser.add_argument(
+        "--client-rate-burst",
+        type=int,
+        help="Accept bursts of up to this many events from each client "
+        "process. Default is 10 seconds' worth of --client-rate-limit.",
+    )
+    parser.add_argument(
+        "--shutdown-timeout",
+        type=int,
+        help="On stopping, upload queued events for up to this many seconds "
+        "before spilling the rest to disk, to be uploaded on the next start. "
+        "Default is 30 seconds.",
+    )
+    parser.add_argument(
+        "--file-sink-dir",
+        help="Also keep events in rotating, gzip'd files under this "
+        "directory, which globus_cw_daemon_backfill can upload later.",
+    )
+    parser.add_argument(
+        "--journald-sink", action="store_true", help="Also send events to journald."
+    )
+    parser.add_argument(
+        "--sink-mode",
+        choices=("tee", "fallback"),
+        help="Write every event to the file and journald sinks (tee), or only "
+        "events whose uploads keep failing, which are then given up on "
+        "(fallback). Default is fallback.",
+    )
+    parser.add_argument(
+        "--sink-fallback-secs",
+        type=int,
+        help="With --sink-mode fallback, give up on uploads failing for this "
+        "many seconds. Default is 300 seconds.",
+    )
+    parser.add_argument(
+        "--allowed-groups",
+        help="Comma-separated log groups, or fnmatch patterns of them, which "
+        "clients may log to besides group_name, to any stream. Default is none.",
+    )
+    parser.add_argument(
+        "--allowed-streams",
+        help="Comma-separated log streams, or fnmatch patterns of them, which "
+        "clients may log to in group_name besides stream_name. Default is none.",
+    )
+    parser.add_argument(
+        "--metrics-port",
+        type=int,
+        help="Serve Prometheus metrics on this port of 127.0.0.1. Default is "
+        "to serve no metrics.",
+    )
 
     args = parser.parse_args()
     group_name = args.group_name
     stream_name = args.stream_name
     heartbeat_interval = args.heartbeat_interval
     no_heartbeats = args.no_heartbeats
+    upload_streams = args.upload_streams
+    metrics_port = args.metrics_port
+    compress_uploads = args.compress_uploads
+    upload_threads = args.upload_threads
+    sequence_tokens = args.sequence_tokens
+    client_rate_limit = args.client_rate_limit
+    client_rate_burst = args.client_rate_burst
+    shutdown_timeout = args.shutdown_timeout
+    file_sink_dir = args.file_sink_dir
+    journald_sink = args.journald_sink
+    sink_mode = args.sink_mode
+    sink_fallback_secs = args.sink_fallback_secs
+    allowed_groups = args.allowed_groups
+    allowed_streams = args.allowed_streams
 
     if heartbeat_interval is not None and heartbeat_interval <= 0:
         raise ValueError("heartbeat interval must be > 0")
@@ -45,6 +142,42 @@ def main():
     if no_heartbeats and heartbeat_interval:
         raise ValueError("Attempting to set heartbeat interval and turn off heartbeats")
 
+    if upload_streams is not None and upload_streams <= 0:
+        raise ValueError("upload streams must be > 0")
+
+    if upload_threads is not None and upload_threads <= 0:
+        raise ValueError("upload threads must be > 0")
+
+    if sequence_tokens and upload_threads:
+        raise ValueError("Attempting to set upload threads and use sequence tokens")
+
+    if client_rate_limit is not None and client_rate_limit <= 0:
+        raise ValueError("client rate limit must be > 0")
+
+    if client_rate_burst is not None and client_rate_burst <= 0:
+        raise ValueError("client rate burst must be > 0")
+
+    if client_rate_burst and not client_rate_limit:
+        raise ValueError("Attempting to set client rate burst without a limit")
+
+    # leave time to spill within the service's TimeoutStopSec
+    if shutdown_timeout is not None and not 0 <= shutdown_timeout <= 60:
+        raise ValueError("shutdown timeout must be between 0 and 60")
+
+    if (sink_mode or sink_fallback_secs is not None) and not (
+        file_sink_dir or journald_sink
+    ):
+        raise ValueError("Attempting to set a sink mode without any sinks")
+
+    if sink_fallback_secs is not None and sink_fallback_secs < 0:
+        raise ValueError("sink fallback secs must be >= 0")
+
+    if sink_fallback_secs is not None and sink_mode == "tee":
+        raise ValueError("Attempting to set sink fallback secs with tee mode")
+
+    if metrics_port is not None and not 0 < metrics_port < 65536:
+        raise ValueError("metrics port must be between 1 and 65535")
+
     # read default-config.ini
     config = configparser.ConfigParser()
     config.read(install_dir_path + "/default-config.ini")
@@ -57,15 +190,41 @@ def main():
         config.set("general", "heartbeat_interval", heartbeat_interval)
     if no_heartbeats:
         config.set("general", "heartbeats", False)
+    if upload_streams:
+        config.set("general", "upload_streams", str(upload_streams))
+    if metrics_port:
+        config.set("general", "metrics_port", str(metrics_port))
+    if compress_uploads:
+        config.set("general", "compress_uploads", "true")
+    if upload_threads:
+        config.set("general", "upload_threads", str(upload_threads))
+    if sequence_tokens:
+        config.set("general", "sequence_tokens", "true")
+    if client_rate_limit:
+        config.set("general", "client_rate_limit", str(client_rate_limit))
+    if client_rate_burst:
+        config.set("general", "client_rate_burst", str(client_rate_burst))
+    if shutdown_timeout is not None:
+        config.set("general", "shutdown_timeout", str(shutdown_timeout))
+    if file_sink_dir:
+        config.set("general", "file_sink_dir", file_sink_dir)
+    if journald_sink:
+        config.set("general", "journald_sink", "true")
+    if sink_mode:
+        config.set("general", "sink_mode", sink_mode)
+    if sink_fallback_secs is not None:
+        config.set("general", "sink_fallback_secs", str(sink_fallback_secs))
+    if allowed_groups is not None:
+        config.set("general", "allowed_groups", allowed_groups)
+    if allowed_streams is not None:
+        config.set("general", "allowed_streams", allowed_streams)
 
     # write config to /etc/cwlogd.ini
     config.write(open("/etc/cwlogd.ini", "w"))
 
-    # globus_cw_daemon.service to /etc/systemd/system/
-    shutil.copy(
-        install_dir_path + "/globus_cw_daemon.service",
-        "/etc/systemd/system/globus_cw_daemon.service",
-    )
+    # globus_cw_daemon.service and .socket to /etc/systemd/system/
+    for unit in ("globus_cw_daemon.service", "globus_cw_daemon.socket"):
+        shutil.copy(install_dir_path + "/" + unit, "/etc/systemd/system/" + unit)
 
 
 if __name__ == "__main__":
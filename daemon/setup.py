@@ -9,6 +9,7 @@ setup(
         "console_scripts": [
             "globus_cw_daemon = globus_cw_daemon.daemon:main",
             "globus_cw_daemon_install = globus_cw_daemon_install.install:main",
+            "globus_cw_daemon_backfill = globus_cw_daemon.backfill:main",
         ]
     },
     include_package_data=True,